@@ -0,0 +1,223 @@
+'''
+Benchmarks every stage of the pipeline: tokenizing and parsing
+(Parser.tokenGenerator, and Parser.accept building a syntax tree),
+Thompson construction, determinization, reduction and matching with
+MatchingVisitor, plus matching with the compiled Pattern. Each pattern is timed separately for
+every stage, with the best of a few runs, and the peak memory of a stage
+is measured in a run of its own under tracemalloc. State counts and
+throughputs are recorded too, and the results written as JSON; given a
+baseline from an earlier run, slower timings are reported as regressions.
+
+    python Benchmark.py --output results.json
+    python Benchmark.py --baseline results.json --sizes 1K 1M 1G
+'''
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from Parser import Stats, Automata, Parser, TreeVisitor, ThompsonVisitor, NfaToDfaVisitor, ReducingVisitor, \
+    MatchingVisitor, Pattern
+
+
+class Benchmark(object):
+    '''
+    Runs the stages of every pattern in PATTERNS, realistic ones and
+    pathological ones, and matches the patterns over texts of the given
+    sizes. MatchingVisitor runs over inputs up to MAX_VISITOR_SIZE only:
+    beyond that it would take hours in pure Python, and only the compiled
+    Pattern is timed.
+    '''
+    PATTERNS = {
+        'word': "Emily*",
+        'names': "Emily|Emil|Emma|Emilia|Amelia|Amanda",
+        'identifier': "[a-z_][a-z0-9_]*",
+        'number': "0x[0-9a-f]+|[0-9]+",
+        'nested-stars': "((a*b*)*(ab)*)*c",
+        'blowup-8': "(a|b)*a" + "(a|b)" * 8,
+        'blowup-12': "(a|b)*a" + "(a|b)" * 12,
+    }
+    MAX_VISITOR_SIZE = 1 << 20
+    ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789_ Emily"
+
+    def __init__ ( self, sizes = (1 << 10, 1 << 16, 1 << 20), repeat = 3, patterns = None, seed = 0 ):
+        self.__sizes = tuple(sizes)
+        self.__repeat = repeat
+        self.__patterns = dict(patterns or self.PATTERNS)
+        self.__seed = seed
+
+    def getSizes ( self ): return self.__sizes
+    sizes = property(getSizes)
+
+    def getPatterns ( self ): return self.__patterns
+    patterns = property(getPatterns)
+
+    def text ( self, size ):
+        '''
+        A reproducible text of size characters: a random block, repeated.
+        '''
+        generator = random.Random(self.__seed)
+        block = ''.join(generator.choice(self.ALPHABET) for i in range(min(size, 1 << 16)))
+        count, rest = divmod(size, len(block)) if block else (0, 0)
+        return ''.join([block] * count + [block[:rest]])     # a single allocation of size characters
+
+    def best ( self, function, setup = None ):
+        '''
+        The shortest time of repeat runs of function, and its last result.
+        With setup, every run is given a fresh result of it, made untimed,
+        for stages that change their input.
+        '''
+        times = []
+        for i in range(self.__repeat):
+            arguments = () if setup is None else (setup(),)
+            started = time.perf_counter()
+            result = function(*arguments)
+            times.append(time.perf_counter() - started)
+        return min(times), result
+
+    def peak ( self, function, setup = None ):
+        '''
+        The peak memory, in bytes, allocated while running function, given
+        a fresh result of setup if any.
+        '''
+        arguments = () if setup is None else (setup(),)
+        tracemalloc.start()
+        try:
+            function(*arguments)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def stages ( self, syntax ):
+        '''
+        The time and peak memory of every compile stage of syntax, and the
+        number of states it produced.
+        '''
+        thompson = []
+        def build ( ):
+            stats = Stats()     # the parser drives the ThompsonVisitor: keep its own time
+            nfa = Parser().accept(ThompsonVisitor(stats), syntax)
+            thompson.append(stats.times['thompson'])
+            return nfa
+        run = {
+            'tokenize': lambda: list(Parser().tokenGenerator(syntax)),
+            'parse': lambda: Parser().accept(TreeVisitor(), syntax),
+            'thompson': build,
+        }
+        result = {'times': {}, 'memory': {}, 'states': {}}
+        for stage in ('tokenize', 'parse', 'thompson'):
+            result['times'][stage], value = self.best(run[stage])
+            result['memory'][stage] = self.peak(run[stage])
+        result['times']['thompson'] = min(thompson)
+
+        nfa = Automata(Parser().accept(ThompsonVisitor(), syntax)[0])
+        result['times']['subset'], dfa = self.best(lambda: nfa.accept(NfaToDfaVisitor()))
+        result['memory']['subset'] = self.peak(lambda: nfa.accept(NfaToDfaVisitor()))
+        # ReducingVisitor prunes transitions in place: every run gets a DFA of its own
+        reduce, determinize = lambda dfa: dfa.accept(ReducingVisitor()), lambda: nfa.accept(NfaToDfaVisitor())
+        result['times']['reduce'], reduced = self.best(reduce, determinize)
+        result['memory']['reduce'] = self.peak(reduce, determinize)
+        result['states'] = {'nfa': len(nfa), 'dfa': len(dfa), 'reduced': len(Automata(reduced.initial))}
+        return result, reduced
+
+    def matching ( self, syntax, dfa ):
+        '''
+        Matching time, throughput in characters per second and peak memory
+        for every size, with MatchingVisitor and with the compiled Pattern.
+        '''
+        pattern = Pattern(syntax)
+        result = {}
+        for size in self.__sizes:
+            text = self.text(size)
+            entry = {}
+            if size <= self.MAX_VISITOR_SIZE:
+                seconds, matches = self.best(lambda: dfa.accept(MatchingVisitor(text)))
+                entry['match'] = {'seconds': seconds, 'throughput': size / seconds if seconds else None,
+                                  'matches': len(matches),
+                                  'memory': self.peak(lambda: dfa.accept(MatchingVisitor(text)))}
+            seconds, spans = self.best(lambda: list(pattern.finditer(text)))
+            entry['pattern'] = {'seconds': seconds, 'throughput': size / seconds if seconds else None,
+                                'matches': len(spans), 'engine': pattern.engine,
+                                'memory': self.peak(lambda: list(pattern.finditer(text)))}
+            result[str(size)] = entry
+        return result
+
+    def run ( self ):
+        results = {'python': sys.version, 'platform': platform.platform(),
+                   'sizes': list(self.__sizes), 'patterns': {}}
+        for name, syntax in self.__patterns.items():
+            compiled, dfa = self.stages(syntax)
+            compiled['syntax'] = syntax
+            compiled['matching'] = self.matching(syntax, dfa)
+            results['patterns'][name] = compiled
+        return results
+
+    @staticmethod
+    def timings ( results ):
+        '''
+        Every timing of results, keyed on (pattern, stage[, size]).
+        '''
+        timings = {}
+        for name, entry in results['patterns'].items():
+            for stage, seconds in entry['times'].items():
+                timings[(name, stage)] = seconds
+            for size, measures in entry['matching'].items():
+                for stage, measure in measures.items():
+                    timings[(name, stage, size)] = measure['seconds']
+        return timings
+
+    @staticmethod
+    def compare ( results, baseline, threshold = 0.2, floor = 1e-4 ):
+        '''
+        The timings of results slower than in baseline by more than
+        threshold, a fraction, as (key, baseline, current) triples. Timings
+        under floor seconds in both are too noisy to tell and skipped.
+        '''
+        before, after = Benchmark.timings(baseline), Benchmark.timings(results)
+        regressions = []
+        for key in sorted(set(before) & set(after)):
+            if max(before[key], after[key]) < floor: continue
+            if after[key] > before[key] * (1 + threshold):
+                regressions.append((key, before[key], after[key]))
+        return regressions
+
+
+def size ( text ):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if text[-1:].upper() in units: return int(text[:-1]) * units[text[-1].upper()]
+    return int(text)
+
+def main ( argv = None ):
+    options = argparse.ArgumentParser(description="Benchmarks the pattern matching pipeline.")
+    options.add_argument('--sizes', nargs='+', type=size, default=[1 << 10, 1 << 16, 1 << 20],
+                         help="input sizes, e.g. 1K 64K 1M 1G")
+    options.add_argument('--repeat', type=int, default=3, help="runs per timing, the best is kept")
+    options.add_argument('--patterns', nargs='+', choices=sorted(Benchmark.PATTERNS),
+                         help="patterns to run, all by default")
+    options.add_argument('--output', help="JSON file to write the results to")
+    options.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    options.add_argument('--threshold', type=float, default=0.2,
+                         help="slowdown reported as a regression, as a fraction")
+    args = options.parse_args(argv)
+
+    patterns = {name: Benchmark.PATTERNS[name] for name in args.patterns} if args.patterns else None
+    results = Benchmark(args.sizes, args.repeat, patterns).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    for name, entry in results['patterns'].items():
+        print("%-14s %s states %s" % (name, ' '.join("%s=%.6f" % item for item in entry['times'].items()),
+                                      entry['states']))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = Benchmark.compare(results, json.load(f), args.threshold)
+        for key, before, after in regressions:
+            print("REGRESSION %s: %.6fs -> %.6fs" % ('/'.join(key), before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
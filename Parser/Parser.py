@@ -1,4 +1,22 @@
-from collections import deque
+from collections import deque, OrderedDict
+from array import array
+import bisect
+import copy
+from functools import reduce
+import mmap
+import struct
+import sys
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import heapq
+
+try:
+    import numpy
+except ImportError:     # batch matching falls back to plain Python
+    numpy = None
 
 class NfaGenerationException(Exception):
     pass
@@ -11,29 +29,261 @@ class NotAnOperatorException(Exception):
 
 class NotAStateException(Exception):
     pass
+
+class SerializationException(Exception):
+    pass
+
+class StateBudgetException(Exception):
+    pass
+
+class PatternSyntaxException(Exception):
+    pass
     
+class Stats(object):
+    '''
+    Counters and per-phase timings collected by the visitors given one.
+    transitions counts matcher steps taken, matchers the matchers started,
+    states the DFA states created by NfaToDfaVisitor and closures the
+    epsilon closures it computed; times holds the seconds spent in each
+    of the PHASES.
+    '''
+    PHASES = ('parse', 'thompson', 'subset', 'reduce', 'match')
+
+    def __init__ ( self ):
+        self.transitions = 0
+        self.matchers = 0
+        self.states = 0
+        self.closures = 0
+        self.times = dict.fromkeys(Stats.PHASES, 0.0)
+
+    def __repr__ ( self ):
+        return "Stats(transitions=%d, matchers=%d, states=%d, closures=%d, times=%r)" % \
+            (self.transitions, self.matchers, self.states, self.closures, self.times)
+
+    @contextmanager
+    def timer ( self, phase ):
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.times[phase] += time.perf_counter() - started
+
+
+class Tracer(object):
+    '''
+    Receives the events of a MatchingVisitor; override what you need.
+    '''
+    def transition ( self, event, position, state ):
+        pass
+
+    def match ( self, match, beg, end ):
+        pass
+
+
+class PrintingTracer(Tracer):
+    def transition ( self, event, position, state ):
+        print("Matched char %s at position %i" % (event, position))
+
+    def match ( self, match, beg, end ):
+        print("Legal match %s at positions (%i,%i)" % (match, beg, end))
+
+
+class CharClass(object):
+    '''
+    A set of characters standing as a single event, for bracketed classes
+    and '.', anything but a newline: sorted, disjoint and non adjacent intervals of code points,
+    bounds included. It isn't iterable, so that State.addTransition takes
+    it as one event rather than as a sequence of them.
+    '''
+    __slots__ = ('__intervals', '__lows')
+
+    def __init__ ( self, intervals ):
+        merged = []
+        for lo, hi in sorted(intervals):
+            if merged and lo <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+            else:
+                merged.append((lo, hi))
+        self.__intervals = tuple(merged)
+        self.__lows = [lo for lo, hi in merged]
+
+    @classmethod
+    def parse ( c, body, negated = False ):
+        '''
+        The class of the members of a bracketed class: characters, and
+        ranges like a-z.
+        '''
+        intervals, i = [], 0
+        while i < len(body):
+            if i + 2 < len(body) and body[i+1] == '-':
+                lo, hi = ord(body[i]), ord(body[i+2])
+                if lo > hi:
+                    raise PatternSyntaxException("Reversed range %s-%s" % (body[i], body[i+2]))
+                intervals.append((lo, hi))
+                i += 3
+            else:
+                intervals.append((ord(body[i]), ord(body[i])))
+                i += 1
+        result = c(intervals)
+        return result.negate() if negated else result
+
+    def negate ( self ):
+        intervals, lo = [], 0
+        for a, b in self.__intervals:
+            if a > lo: intervals.append((lo, a-1))
+            lo = b+1
+        if lo <= sys.maxunicode: intervals.append((lo, sys.maxunicode))
+        return CharClass(intervals)
+
+    def getIntervals ( self ): return self.__intervals
+    intervals = property(getIntervals)
+
+    def size ( self ):
+        return sum(hi - lo + 1 for lo, hi in self.__intervals)
+
+    def chars ( self ):
+        for lo, hi in self.__intervals:
+            for point in range(lo, hi+1):
+                yield chr(point)
+
+    def __contains__ ( self, c ):
+        point = ord(c)
+        i = bisect.bisect_right(self.__lows, point) - 1
+        return i >= 0 and point <= self.__intervals[i][1]
+
+    def __eq__ ( self, obj ):
+        return isinstance(obj, CharClass) and self.__intervals == obj.__intervals
+
+    def __ne__ ( self, obj ):
+        return not self == obj
+
+    def __hash__ ( self ):
+        return hash(self.__intervals)
+
+    def __repr__ ( self ):
+        show = lambda p: chr(p) if chr(p).isprintable() and chr(p) not in '[]^-\\' else '\\x{%x}' % p
+        return '[%s]' % ''.join(show(lo) if lo == hi else show(lo) + '-' + show(hi)
+                                for lo, hi in self.__intervals)
+
+CharClass.DOT = CharClass.parse('\n', True)     # '.': anything but a newline
+
+
+class Repeat(object):
+    '''
+    Counted repetition, the parser's postfix operator {m}, {m,} or {m,n}:
+    its operand min to max times, max None meaning no bound. It binds
+    like '*'.
+    '''
+    __slots__ = ('min', 'max')
+
+    def __init__ ( self, min, max ):
+        self.min = min
+        self.max = max
+
+    @classmethod
+    def parse ( c, body ):
+        '''
+        The repetition of the body of braces: m, m, or m,n.
+        '''
+        low, comma, high = body.partition(',')
+        try:
+            result = c(int(low), int(high) if high else (None if comma else int(low)))
+        except ValueError:
+            raise PatternSyntaxException("Bad repetition {%s}" % body)
+        if result.min < 0 or result.max is not None and not 0 < result.max >= result.min:
+            raise PatternSyntaxException("Bad repetition {%s}" % body)
+        return result
+
+    def __eq__ ( self, obj ):
+        return isinstance(obj, Repeat) and (self.min, self.max) == (obj.min, obj.max)
+
+    def __ne__ ( self, obj ):
+        return not self == obj
+
+    def __hash__ ( self ):
+        return hash((self.min, self.max))
+
+    def __repr__ ( self ):
+        if self.max == self.min: return "{%d}" % self.min
+        return "{%d,%s}" % (self.min, '' if self.max is None else self.max)
+
+
+class Alphabet(object):
+    '''
+    Partition of the characters into atoms, the maximal intervals over
+    which none of a set of events, characters or CharClass, tells
+    characters apart. Each event is a union of atoms, and atoms are
+    disjoint, as subset construction needs. An atom is labelled by its
+    character if it holds a single one, by the CharClass of its interval
+    otherwise.
+    '''
+    def __init__ ( self, events ):
+        bounds = {0, sys.maxunicode + 1}
+        for e in events:
+            for lo, hi in self.intervalsOf(e):
+                bounds.add(lo)
+                bounds.add(hi + 1)
+        self.__bounds = sorted(bounds)      # atom k is bounds[k] .. bounds[k+1]-1
+        self.__labels = {}
+
+    def __len__ ( self ):
+        return len(self.__bounds) - 1
+
+    @staticmethod
+    def intervalsOf ( event ):
+        if isinstance(event, CharClass): return event.intervals
+        return ((ord(event), ord(event)),)
+
+    def atomsOf ( self, event ):
+        bounds = self.__bounds
+        return [k for lo, hi in self.intervalsOf(event)
+                  for k in range(bisect.bisect_right(bounds, lo) - 1, bisect.bisect_right(bounds, hi))]
+
+    def label ( self, atom ):
+        lo, hi = self.__bounds[atom], self.__bounds[atom+1] - 1
+        return chr(lo) if lo == hi else CharClass(((lo, hi),))
+
+    def labelsOf ( self, event ):
+        return [self.label(k) for k in self.atomsOf(event)]
+
+    def labelOf ( self, c ):
+        '''
+        The label of the atom holding character c, remembered.
+        '''
+        try:
+            return self.__labels[c]
+        except KeyError:
+            label = self.__labels[c] = self.label(bisect.bisect_right(self.__bounds, ord(c)) - 1)
+            return label
+
+
 class Automata(set):
 
     EPSILON = 0
     
     class State(object):
+        __slots__ = ('__id', '__accepting', '__transitions', '__classes', '__owners')
         id_generator = 0
+        id_lock = threading.Lock()  # states are created from many threads at once
     
         @classmethod
         def nextId ( c ):
-            try:
+            with c.id_lock:
                 c.id_generator = c.id_generator+1
-            except:
-                c.id_generator = 0
-            return c.id_generator
+                return c.id_generator
             
         def __init__ ( self, stid = None ):
             self.__id = stid or self.nextId()
             self.__accepting = False
             self.__transitions = {}
+            self.__classes = []     # the CharClass events among the transitions
+            self.__owners = None    # weak references to the automata holding this state
 
         def __eq__ ( self, obj ):
             return self.__id == obj.__id
+
+        def __hash__ ( self ):
+            return hash(self.__id)
             
         def __lt__ ( self, obj ):
             return self.__id < obj.__id
@@ -47,7 +297,9 @@ class Automata(set):
         id = property(getId)
         
         def getAccepting ( self ) : return self.__accepting
-        def setAccepting ( self, acc ): self.__accepting = acc
+        def setAccepting ( self, acc ):
+            self.__accepting = acc
+            if self.__owners: self.changed()
         accepting = property(getAccepting, setAccepting)
             
         def addTransition ( self, event, target ):
@@ -57,25 +309,191 @@ class Automata(set):
                 event = (event,) 
             finally:
                 for e in event:
+                    if isinstance(e, CharClass) and e not in self.__transitions: self.__classes.append(e)
                     self.__transitions[e] = self.__transitions.get(e, ()) + (target,)
+                if self.__owners: self.changed()
 
         def removeTransition ( self, target ):
             for event in self.__transitions:
                 self.__transitions[event] = \
                     tuple(filter(lambda s: s != target, self.__transitions[event]))
+            if self.__owners: self.changed()
+
+        def own ( self, automata ):
+            '''
+            Records that automata holds this state, so that its index is
+            dropped when this state changes.
+            '''
+            owner = weakref.ref(automata)
+            if self.__owners is None:
+                self.__owners = [owner]
+            elif not any(o() is automata for o in self.__owners):   # not ==: equal sets are other automata
+                self.__owners = [o for o in self.__owners if o() is not None] + [owner]
+
+        def changed ( self ):
+            for owner in self.__owners:
+                automata = owner()
+                if automata is not None: automata.invalidate()
                     
         def next ( self, event=None ):
             if event is None: return self.__transitions
-            return self.__transitions.get(event, tuple())
+            targets = self.__transitions.get(event, tuple())
+            if self.__classes and isinstance(event, str) and len(event) == 1:    # and the classes holding it
+                for e in self.__classes:
+                    if event in e: targets += self.__transitions[e]
+            return targets
         
         def fringe ( self ):
-            return reduce(lambda s1, s2: set(s1).union(s2), self.__transitions.itervalues())
+            return reduce(lambda s1, s2: set(s1).union(s2), self.__transitions.values(), set())
             
+        @staticmethod
+        def merge ( values ):
+            '''
+            The accepting value of a state standing for states whose
+            accepting values are given: the union of the sets of pattern
+            ids among them if any, whether any of them accepts otherwise.
+            '''
+            ids = [v for v in values if isinstance(v, (set, frozenset))]
+            if any(ids): return frozenset().union(*ids)
+            return any(values)
+
         def isDeadEnd ( self ):
-            return self.fringe() == {self,}
+            return not self.accepting and self.fringe() == {self,}
+
+    class Index(object):
+        '''
+        Numbers the states of an automata so that sets of states can be
+        handled as int bitsets, and precomputes the epsilon closure and
+        the per-event targets of every state as bitsets.
+        '''
+        def __init__ ( self, automata ):
+            self.states = list(automata)
+            self.positions = {s: i for i, s in enumerate(self.states)}
+            self.moves = [{} for s in self.states]
+            self.epsilons = [0] * len(self.states)
+            self.accepting = 0
+            self.alphabet = self.splitIndex = None
+            for i, state in enumerate(self.states):
+                if state.accepting: self.accepting |= 1 << i
+                for event, targets in state.next().items():
+                    bits = self.bits(targets)
+                    if event == Automata.EPSILON: self.epsilons[i] = bits
+                    elif bits: self.moves[i][event] = bits
+            self.closures = self.__closures()
+
+        def __closures ( self ):
+            '''
+            Iterative Tarjan over the epsilon transitions: strongly connected
+            components come out after every component they reach, so each
+            closure is the component's states plus the closures, already
+            complete, of the states it reaches.
+            '''
+            n, epsilons, positionsOf = len(self.states), self.epsilons, self.positionsOf
+            closures, order, low = [0] * n, [None] * n, [0] * n
+            stack, onStack, counter = [], [False] * n, 0
+            for root in range(n):
+                if order[root] is not None: continue
+                order[root] = low[root] = counter
+                counter += 1
+                stack.append(root)
+                onStack[root] = True
+                work = [(root, positionsOf(epsilons[root]))]
+                while work:
+                    v, successors = work[-1]
+                    for w in successors:
+                        if order[w] is None:
+                            order[w] = low[w] = counter
+                            counter += 1
+                            stack.append(w)
+                            onStack[w] = True
+                            work.append((w, positionsOf(epsilons[w])))
+                            break
+                        elif onStack[w]:
+                            low[v] = min(low[v], order[w])
+                    else:
+                        work.pop()
+                        if work:
+                            u = work[-1][0]
+                            low[u] = min(low[u], low[v])
+                        if low[v] == order[v]:
+                            component, bits = [], 0
+                            while not component or component[-1] != v:
+                                w = stack.pop()
+                                onStack[w] = False
+                                component.append(w)
+                                bits |= 1 << w
+                            for w in component:
+                                for x in positionsOf(epsilons[w]):
+                                    bits |= closures[x]
+                            for w in component:
+                                closures[w] = bits
+            return closures
+
+        @staticmethod
+        def positionsOf ( bits ):
+            while bits:
+                low = bits & -bits
+                yield low.bit_length() - 1
+                bits ^= low
+
+        def bits ( self, states ):
+            result = 0
+            try:
+                for s in states:
+                    result |= 1 << self.positions[s]
+            except KeyError:
+                raise NotAStateException(s)
+            return result
+
+        def statesOf ( self, bits ):
+            return {self.states[i] for i in self.positionsOf(bits)}
+
+        def closure ( self, bits ):
+            result, closures = bits, self.closures
+            for i in self.positionsOf(bits):
+                result |= closures[i]
+            return result
+
+        def move ( self, bits, event ):
+            result, moves = 0, self.moves
+            for i in self.positionsOf(bits):
+                result |= moves[i].get(event, 0)
+            return result
+
+        def events ( self, bits ):
+            moves = self.moves
+            return {e for i in self.positionsOf(bits) for e in moves[i]}
+
+        def split ( self ):
+            '''
+            This index with its events split into the atoms of their
+            Alphabet when some are CharClass, so that the events of any set
+            of states are disjoint; labelOf then maps a character to its
+            event.
+            '''
+            if self.splitIndex is None:
+                events = {e for moves in self.moves for e in moves}
+                if self.alphabet is not None or not any(isinstance(e, CharClass) for e in events):
+                    self.splitIndex = self
+                else:
+                    split = copy.copy(self)
+                    split.alphabet = alphabet = Alphabet(events)
+                    split.moves = []
+                    for moves in self.moves:
+                        labels = {}
+                        for e, targets in moves.items():
+                            for label in alphabet.labelsOf(e):
+                                labels[label] = labels.get(label, 0) | targets
+                        split.moves.append(labels)
+                    split.splitIndex = self.splitIndex = split
+            return self.splitIndex
+
+        def labelOf ( self, c ):
+            return c if self.alphabet is None else self.alphabet.labelOf(c)
 
     def __init__ ( self, initial=None ):
         self.__initial = initial
+        self.__index = None
         self.add(initial)
         
     def getInitial ( self ): return self.__initial
@@ -84,60 +502,409 @@ class Automata(set):
     def add ( self, state ):
         if state:
             if not self.__initial: self.__initial = state
+            self.__index = None
             super(Automata, self).add(state)
-            for event in state.next():
-                for s in filter(lambda s: not s in self, state.next(event)):
-                    self.add(s)
+            state.own(self)
+            pending = [state]
+            while pending:  # iterative, so deep automata don't hit the recursion limit
+                for targets in pending.pop().next().values():
+                    for s in targets:
+                        if s not in self:
+                            super(Automata, self).add(s)
+                            s.own(self)
+                            pending.append(s)
 
     def update ( self, automata ):
         try:
             return self.add(automata.initial)
         except AttributeError:
-            return super(Automata, self).update(automata)
+            states = list(automata)
+            self.__index = None
+            super(Automata, self).update(states)
+            for s in states: s.own(self)
+
+    def index ( self ):
+        index = self.__index
+        if index is None:
+            for state in list(self):    # take in the states linked to since they were added
+                for targets in state.next().values():
+                    for s in targets:
+                        if s not in self: self.add(s)
+            index = self.__index = Automata.Index(self)
+        return index
+
+    def invalidate ( self ):
+        self.__index = None
 
     def closure ( self, states, event ):
-        result = set()
-        if event == Automata.EPSILON: result.update(states)
-        for s in states:
-            if event == Automata.EPSILON:
-                result.update(self.closure(s.next(event), event))
-            else:
-                result.update(s.next(event))
-        return result
+        index = self.index().split()
+        bits = index.bits(states)
+        if event == Automata.EPSILON:
+            return index.statesOf(index.closure(bits))
+        return index.statesOf(index.move(bits, index.labelOf(event)))
             
     def accept ( self, visitor ):
         return visitor.visit(self)        
         
+class CompactAutomata(object):
+    '''
+    Automata stored in flat arrays: states are the integers 0..n-1 and
+    transitions are appended to parallel source/event/target arrays, which
+    are regrouped by source state, CSR style, the first time transitions
+    are read after a change: the transitions of state s are then those
+    between offsets[s] and offsets[s+1]. CompactAutomata.State is a thin
+    view with the Automata.State interface, so ThompsonVisitor can build
+    into a CompactAutomata through a Parser whose factory is its newState,
+    and NfaToDfaVisitor determinizes one into another.
+    '''
+
+    class State(object):
+        __slots__ = ('automata', 'id')
+
+        def __init__ ( self, automata, sid ):
+            self.automata = automata
+            self.id = sid
+
+        def __eq__ ( self, obj ):
+            return self.id == obj.id and self.automata is obj.automata
+
+        def __hash__ ( self ):
+            return self.id
+
+        def __lt__ ( self, obj ):
+            return self.id < obj.id
+
+        def __repr__ ( self ):
+            set_repr = lambda ss: ','.join(map(lambda s: str(s.id), ss))
+            tr_repr = lambda it: "%s->(%s)" % (it[0], set_repr(it[1]))
+            return "(%s):{%s}" % (str(self.id), ','.join(map(tr_repr, self.next().items())))
+
+        def getAccepting ( self ): return self.automata.isAccepting(self.id)
+        def setAccepting ( self, acc ): self.automata.setAccepting(self.id, acc)
+        accepting = property(getAccepting, setAccepting)
+
+        def addTransition ( self, event, target ):
+            try:
+                if not any(event): return
+            except TypeError:
+                event = (event,)
+            for e in event:
+                self.automata.addTransition(self.id, e, target.id)
+
+        def removeTransition ( self, target ):
+            self.automata.removeTransition(self.id, target.id)
+
+        def next ( self, event=None ):
+            automata = self.automata
+            if event is None:
+                return {e: tuple(automata.state(t) for t in targets)
+                        for e, targets in automata.next(self.id).items()}
+            return tuple(automata.state(t) for t in automata.next(self.id, event))
+
+        def fringe ( self ):
+            return {self.automata.state(t) for t in self.automata.targets(self.id)}
+
+        def isDeadEnd ( self ):
+            return not self.accepting and self.fringe() == {self,}
+
+    class Index(Automata.Index):
+        '''
+        Automata.Index over a CompactAutomata, where the position of every
+        state is its id.
+        '''
+        def __init__ ( self, automata ):
+            self.generation = automata.generation
+            self.states = [automata.state(i) for i in range(len(automata))]
+            self.positions = {s: s.id for s in self.states}
+            self.moves = [{} for i in range(len(automata))]
+            self.epsilons = [0] * len(automata)
+            self.accepting = 0
+            self.alphabet = self.splitIndex = None
+            for i, state in enumerate(self.states):
+                if automata.isAccepting(i): self.accepting |= 1 << i
+                for event, targets in automata.next(i).items():
+                    bits = 0
+                    for t in targets: bits |= 1 << t
+                    if event == Automata.EPSILON: self.epsilons[i] = bits
+                    else: self.moves[i][event] = bits
+            self.closures = self.__closures()
+
+        def bits ( self, states ):
+            result = 0
+            for s in states:
+                if not 0 <= s.id < len(self.states) or self.states[s.id] != s:
+                    raise NotAStateException(s)
+                result |= 1 << s.id
+            return result
+
+    def __init__ ( self, initial=None ):
+        self.__accepting = []
+        self.__sources, self.__targets = array('l'), array('l')
+        self.__events = []
+        self.__classes = False      # whether any event is a CharClass
+        self.__offsets = None
+        self.__generation = 0
+        self.__index = None
+        self.__initial = initial.id if initial is not None else None
+
+    def __len__ ( self ):
+        return len(self.__accepting)
+
+    def __iter__ ( self ):
+        return (self.state(i) for i in range(len(self)))
+
+    def __contains__ ( self, state ):
+        return getattr(state, 'automata', None) is self
+
+    def getInitial ( self ):
+        return self.state(self.__initial) if self.__initial is not None else None
+    def setInitial ( self, state ): self.__initial = state.id
+    initial = property(getInitial, setInitial)
+
+    def getGeneration ( self ): return self.__generation
+    generation = property(getGeneration)
+
+    def state ( self, sid ):
+        return CompactAutomata.State(self, sid)
+
+    def newState ( self ):
+        self.__accepting.append(False)
+        if self.__initial is None: self.__initial = len(self.__accepting) - 1
+        return self.state(len(self.__accepting) - 1)
+
+    def isAccepting ( self, sid ):
+        return self.__accepting[sid]
+
+    def setAccepting ( self, sid, acc ):
+        self.__accepting[sid] = acc
+        self.__generation += 1
+
+    def addTransition ( self, source, event, target ):
+        self.__sources.append(source)
+        self.__events.append(event)
+        self.__targets.append(target)
+        self.__classes = self.__classes or isinstance(event, CharClass)
+        self.__offsets = None
+        self.__generation += 1
+
+    def removeTransition ( self, source, target ):
+        self.freeze()
+        keep = [j for j in range(len(self.__targets))
+                if self.__sources[j] != source or self.__targets[j] != target]
+        self.__sources = array('l', (self.__sources[j] for j in keep))
+        self.__events = [self.__events[j] for j in keep]
+        self.__targets = array('l', (self.__targets[j] for j in keep))
+        self.__offsets = None
+        self.__generation += 1
+
+    def freeze ( self ):
+        '''
+        Regroups the transitions by source state with a counting sort.
+        '''
+        if self.__offsets is not None: return
+        offsets = array('l', [0]) * (len(self) + 1)
+        for source in self.__sources:
+            offsets[source+1] += 1
+        for i in range(len(self)):
+            offsets[i+1] += offsets[i]
+        slots = array('l', offsets)
+        events = [None] * len(self.__events)
+        sources, targets = array('l', self.__sources), array('l', self.__targets)
+        for j, source in enumerate(self.__sources):
+            k = slots[source]
+            slots[source] += 1
+            sources[k], events[k], targets[k] = source, self.__events[j], self.__targets[j]
+        self.__sources, self.__events, self.__targets = sources, events, targets
+        self.__offsets = offsets
+
+    def next ( self, sid, event=None ):
+        self.freeze()
+        beg, end = self.__offsets[sid], self.__offsets[sid+1]
+        events, targets = self.__events, self.__targets
+        if event is not None:
+            if self.__classes and isinstance(event, str) and len(event) == 1:    # and the classes holding it
+                return tuple(targets[j] for j in range(beg, end) if events[j] == event or
+                             isinstance(events[j], CharClass) and event in events[j])
+            return tuple(targets[j] for j in range(beg, end) if events[j] == event)
+        result = {}
+        for j in range(beg, end):
+            result[events[j]] = result.get(events[j], ()) + (targets[j],)
+        return result
+
+    def targets ( self, sid ):
+        self.freeze()
+        return set(self.__targets[self.__offsets[sid]:self.__offsets[sid+1]])
+
+    def index ( self ):
+        if self.__index is None or self.__index.generation != self.__generation:
+            self.__index = CompactAutomata.Index(self)
+        return self.__index
+
+    def closure ( self, states, event ):
+        index = self.index().split()
+        bits = index.bits(states)
+        if event == Automata.EPSILON:
+            return index.statesOf(index.closure(bits))
+        return index.statesOf(index.move(bits, index.labelOf(event)))
+
+    def accept ( self, visitor ):
+        return visitor.visit(self)
+
+
 class NfaToDfaVisitor(object):
+    '''
+    Subset construction. With maxStates set, raises StateBudgetException
+    as soon as the DFA grows beyond that many states.
+    '''
+    def __init__ ( self, stats = None, maxStates = None ):
+        self.__stats = stats
+        self.__maxStates = maxStates
+
     def visit ( self, nfa ):
-        visited = {}
+        if self.__stats is None: return self.determinize(nfa)
+        with self.__stats.timer('subset'):
+            return self.determinize(nfa)
+
+    def determinize ( self, nfa ):
+        index = nfa.index().split()
+        ic = index.closure(index.bits((nfa.initial,)))
+        compact = CompactAutomata() if isinstance(nfa, CompactAutomata) else None
+        initial = self.newState(index, ic, compact)
+        visited, closures = {ic: initial}, 1
         Dstates = deque()
-        ic = nfa.closure((nfa.initial,), Automata.EPSILON)
-        initial = Automata.State(ic)
-        Dstates.appendleft(initial)
+        Dstates.appendleft(ic)
         while len(Dstates):
-            state = Dstates.pop()
-            events = {e for s in state.id for e in s.next() if e != Automata.EPSILON}
-            for e in events:
-                u = nfa.closure(nfa.closure(state.id, e), Automata.EPSILON)
+            bits = Dstates.pop()
+            state = visited[bits]
+            for e in index.events(bits):
+                u = index.closure(index.move(bits, e))
+                closures += 1
                 try:
-                    new_state = visited[repr(u)]
+                    new_state = visited[u]
                 except KeyError:
-                    new_state = Automata.State(u)
-                    new_state.accepting = any(s.accepting for s in u)
-                    Dstates.appendleft(new_state)
+                    if self.__maxStates is not None and len(visited) >= self.__maxStates:
+                        raise StateBudgetException("DFA beyond %d states" % self.__maxStates)
+                    new_state = visited[u] = self.newState(index, u, compact)
+                    Dstates.appendleft(u)
                 state.addTransition(e, new_state)
-            visited[repr(state.id)] = state
-        return Automata(initial)
+        if self.__stats is not None:
+            self.__stats.states += len(visited)
+            self.__stats.closures += closures
+        return compact if compact is not None else Automata(initial)
+
+    def newState ( self, index, bits, compact = None ):
+        if compact is None:
+            state = Automata.State(frozenset(index.statesOf(bits)))
+        else:
+            state = compact.newState()
+        accepting = index.statesOf(bits & index.accepting)
+        state.accepting = Automata.State.merge([s.accepting for s in accepting])
+        return state
+
+class LazyDfa(object):
+    '''
+    DFA built on the fly from an NFA, RE2 style: a DFA state is the
+    epsilon-closed set of NFA states it stands for, as an Automata.Index
+    bitset, and it is only
+    determinized when the input reaches it. Determinized states are kept
+    in a cache of at most maxStates entries; when the cache is full it is
+    flushed and determinization starts over from whatever states the
+    matchers are in, so memory stays bounded no matter the pattern.
+    '''
+    DEAD = 0
+
+    def __init__ ( self, nfa, maxStates = 10000 ):
+        self.__index = index = nfa.index().split()
+        self.__maxStates = maxStates
+        self.__cache = {}
+        self.__flushes = 0
+        self.__initial = index.closure(index.bits((nfa.initial,)))
+
+    def __len__ ( self ):
+        return len(self.__cache)
+
+    def getInitial ( self ): return self.__initial
+    initial = property(getInitial)
+
+    def getMaxStates ( self ): return self.__maxStates
+    maxStates = property(getMaxStates)
+
+    def getFlushes ( self ): return self.__flushes
+    flushes = property(getFlushes)
+
+    def state ( self, key ):
+        try:
+            return self.__cache[key]
+        except KeyError:
+            if len(self.__cache) >= self.__maxStates:
+                self.__cache.clear()
+                self.__flushes += 1
+            entry = self.__cache[key] = (bool(key & self.__index.accepting), {})
+            return entry
+
+    def next ( self, key, event ):
+        transitions = self.state(key)[1]
+        try:
+            return transitions[event]
+        except KeyError:
+            index = self.__index
+            target = transitions[event] = index.closure(index.move(key, index.labelOf(event)))
+            return target
+
+    def isAccepting ( self, key ):
+        return self.state(key)[0]
+
+    def accept ( self, visitor ):
+        return visitor.visit(self)
+
+
+class LazyMatchingVisitor(object):
+    '''
+    Same matching semantics as CompiledMatchingVisitor, run on a LazyDfa.
+    '''
+    def __init__ ( self, string ):
+        self.__string = string
+        self.__matches = []
+
+    def visit ( self, ldfa ):
+        string, matches = self.__string, []
+        self.__matches = matches
+        dead, initial = LazyDfa.DEAD, ldfa.initial
+        active = []
+        for i, c in enumerate(string):
+            survivors = []
+            active.append((initial, i))
+            for key, beg in active:
+                key = ldfa.next(key, c)
+                if key != dead:
+                    if ldfa.isAccepting(key):
+                        matches.append(string[beg:i+1])
+                    survivors.append((key, beg))
+            active = survivors
+        return matches
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+    def getMatches ( self ):
+        return self.__matches
+    matches = property(getMatches)
 
 class ReducingVisitor(object):
+    def __init__ ( self, stats = None ):
+        self.__stats = stats
+
     def visit ( self, dfa ):
+        started = time.perf_counter()
         try:
             visited = set()
             self.__recurse(dfa.initial, visited)
         except AttributeError:
             pass    # not an automata
         finally:
+            if self.__stats is not None:
+                self.__stats.times['reduce'] += time.perf_counter() - started
             return dfa
             
     def __recurse ( self, state, visited ):
@@ -149,33 +916,140 @@ class ReducingVisitor(object):
                 else:
                     self.__recurse(s, visited)  # the recursive case
 
+class MinimizingVisitor(object):
+    '''
+    Hopcroft's partition refinement. Missing transitions are treated as
+    going to an implicit sink state, so states that can never reach an
+    accepting state end up merged with the sink and are dropped, which
+    makes ReducingVisitor unnecessary afterwards. Each state of the
+    resulting DFA is identified by the set of original states it stands for.
+    '''
+    def __init__ ( self, stats = None ):
+        self.__stats = stats
+
+    def visit ( self, dfa ):
+        if self.__stats is None: return self.minimize(dfa)
+        with self.__stats.timer('reduce'):
+            return self.minimize(dfa)
+
+    def minimize ( self, dfa ):
+        states = [dfa.initial]
+        index = {dfa.initial: 0}
+        for state in states:
+            for targets in state.next().values():
+                for s in targets:
+                    if s not in index:
+                        index[s] = len(states)
+                        states.append(s)
+
+        sink = len(states)
+        events = sorted({e for s in states for e in s.next() if e != Automata.EPSILON}, key=repr)
+        delta = {e: [index[s.next(e)[0]] if any(s.next(e)) else sink for s in states] + [sink]
+                 for e in events}
+        inverse = {}
+        for e in events:
+            inverse[e] = [[] for i in range(sink+1)]
+            for source, target in enumerate(delta[e]):
+                inverse[e][target].append(source)
+
+        blocks, blockOf = self.refine(states, events, inverse)
+
+        block = blockOf[0]
+        if block == blockOf[sink]:  # the empty language
+            return Automata(Automata.State(frozenset(states)))
+
+        result = {}
+        for b in sorted(set(blockOf[:sink]) - {blockOf[sink]}):
+            result[b] = Automata.State(frozenset(states[i] for i in blocks[b]))
+            result[b].accepting = states[min(blocks[b])].accepting
+        for b, state in result.items():
+            rep = min(blocks[b])
+            for e in events:
+                target = blockOf[delta[e][rep]]
+                if target in result:
+                    state.addTransition(e, result[target])
+        return Automata(result[block])
+
+    def refine ( self, states, events, inverse ):
+        sink = len(states)
+        groups = {False: {sink}}    # states accepting the same patterns start together
+        for i, s in enumerate(states):
+            groups.setdefault(s.accepting or False, set()).add(i)
+        blocks = list(groups.values())
+        blockOf = [0] * (sink+1)
+        for b, block in enumerate(blocks):
+            for i in block:
+                blockOf[i] = b
+
+        waiting = set(range(len(blocks)))
+        while waiting:
+            splitter = tuple(blocks[waiting.pop()])
+            for e in events:
+                touched = {}
+                for target in splitter:
+                    for source in inverse[e][target]:
+                        touched.setdefault(blockOf[source], []).append(source)
+                for b, sources in touched.items():
+                    if len(sources) == len(blocks[b]): continue
+                    split = set(sources)
+                    blocks[b] -= split
+                    blocks.append(split)
+                    for i in split:
+                        blockOf[i] = len(blocks) - 1
+                    if b in waiting or len(split) <= len(blocks[b]):
+                        waiting.add(len(blocks) - 1)
+                    else:
+                        waiting.add(b)
+        return blocks, blockOf
+
 class MatchingVisitor(object):
-    def __init__ ( self, string ):
+    '''
+    Finds every match of a DFA in a string. A Tracer, e.g. PrintingTracer,
+    is told about every transition and match, and a Stats gets the number
+    of transitions and matchers and the time spent; without them the loop
+    only pays for a couple of local counters.
+    '''
+    def __init__ ( self, string, tracer = None, stats = None ):
         self.__string = string
         self.__matches = []
+        self.__tracer = tracer
+        self.__stats = stats
         
     def visit ( self, dfa ):
-        activestates = deque()
-        for i, c in enumerate(self.__string):
+        string, matches, tracer = self.__string, [], self.__tracer
+        self.__matches = matches
+        started, transitions = time.perf_counter(), 0
+        matchers, activestates = 0, deque()
+        for i, c in enumerate(string):
+            survivors = deque()
             for matcherstate in activestates:
                 state, beg = matcherstate
                 nextstates = state.next(c)
                 if any(nextstates):
-                    print("Matched char %s at position %i" % (c, i))
+                    transitions += 1
+                    if tracer is not None: tracer.transition(c, i, nextstates[0])
                     if nextstates[0].accepting:
-                        self.__matches.append(self.__string[beg:i+1])
-                        print("Legal match %s at positions (%i,%i)" % (self.__string[beg:i+1], beg, i+1))
+                        matches.append(string[beg:i+1])
+                        if tracer is not None: tracer.match(string[beg:i+1], beg, i+1)
                     matcherstate[0] = nextstates[0]
+                    survivors.append(matcherstate)
                     
             nextstates = dfa.initial.next(c)
             if any(nextstates):
-                print("Matched char %s at position %i" % (c, i))
+                transitions += 1
+                if tracer is not None: tracer.transition(c, i, nextstates[0])
                 if nextstates[0].accepting:
-                    self.__matches.append(self.__string[i:i+1])
-                    print("Legal match %s at positions (%i,%i)" % (self.__string[i:i+1], i, i+1))
-                activestates.append([nextstates[0], i])
-                
-        return self.__matches
+                    matches.append(string[i:i+1])
+                    if tracer is not None: tracer.match(string[i:i+1], i, i+1)
+                survivors.append([nextstates[0], i])
+                matchers += 1
+            activestates = survivors
+
+        if self.__stats is not None:
+            self.__stats.transitions += transitions
+            self.__stats.matchers += matchers
+            self.__stats.times['match'] += time.perf_counter() - started
+        return matches
 
     def getString ( self ):
         return self.__string
@@ -184,33 +1058,904 @@ class MatchingVisitor(object):
     def getMatches ( self ):
         return self.__matches
     matches = property(getMatches)
-    
-    
+
+
+class CompiledDfa(object):
+    '''
+    Dense, table-driven form of a DFA. States are numbered 0..n-1 with 0
+    being the initial state, and input characters are mapped to
+    equivalence classes through a class map (class 0 gathers every
+    character the DFA has no transition for), whose keys are characters
+    or, for the atoms of an Alphabet, CharClass intervals. The transition
+    for state s and class k lives at table[s * nclasses + k], DEAD meaning
+    no transition at all.
+    '''
+    DEAD = -1
+
+    def __init__ ( self, classes, nclasses, table, accepting, payloads = None ):
+        self.__classes = classes
+        self.__chars = {e: k for e, k in classes.items() if not isinstance(e, CharClass)}
+        self.__intervals = sorted((lo, hi, k) for e, k in classes.items() if isinstance(e, CharClass)
+                                              for lo, hi in e.intervals)
+        self.__lows = [lo for lo, hi, k in self.__intervals]
+        self.__nclasses = nclasses
+        self.__table = table
+        self.__accepting = accepting
+        self.__payloads = payloads or tuple(bool(a) for a in accepting)
+        self.__ids = None
+        self.__byteClasses = None
+        if nclasses <= 256:
+            self.__byteClasses = bytes(self.classOf(chr(b)) for b in range(256))
+
+    def __len__ ( self ):
+        return len(self.__accepting)
+
+    def getClasses ( self ): return self.__classes
+    classes = property(getClasses)
+
+    def getNClasses ( self ): return self.__nclasses
+    nclasses = property(getNClasses)
+
+    def getTable ( self ): return self.__table
+    table = property(getTable)
+
+    def getAccepting ( self ): return self.__accepting
+    accepting = property(getAccepting)
+
+    def getPayloads ( self ):
+        '''
+        The accepting value of every state: a boolean, or the set of ids of
+        the patterns it accepts for a PatternSet.
+        '''
+        return self.__payloads
+    payloads = property(getPayloads)
+
+    def getIds ( self ):
+        '''
+        The set of pattern ids accepted by every state, a plain pattern
+        being pattern 0.
+        '''
+        if self.__ids is None:
+            self.__ids = tuple(p if isinstance(p, (set, frozenset)) else frozenset((0,) if p else ())
+                               for p in self.__payloads)
+        return self.__ids
+    ids = property(getIds)
+
+    def getByteClasses ( self ):
+        '''
+        A 256-byte translation table mapping every byte, read as a latin-1
+        character, to its class; None when classes don't fit in a byte.
+        '''
+        return self.__byteClasses
+    byteClasses = property(getByteClasses)
+
+    def ranges ( self ):
+        '''
+        The class map as sorted (first, last code point, class) triples.
+        '''
+        return sorted([(ord(c), ord(c), k) for c, k in self.__chars.items()] + self.__intervals)
+
+    def classOf ( self, event, default = 0 ):
+        k = self.__chars.get(event)
+        if k is not None or not self.__intervals: return default if k is None else k
+        point = ord(event)
+        i = bisect.bisect_right(self.__lows, point) - 1
+        return self.__intervals[i][2] if i >= 0 and point <= self.__intervals[i][1] else default
+
+    def classifier ( self, string = '' ):
+        '''
+        A function from an item of string, a character or for bytes a byte,
+        and a default, to its class: for characters dict.get of the class
+        map when it only holds characters, otherwise classOf behind a cache
+        of the characters seen; for bytes a lookup in byteClasses.
+        '''
+        if not isinstance(string, str):
+            byteClasses = self.__byteClasses or [self.classOf(chr(b)) for b in range(256)]
+            return lambda b, default = 0: byteClasses[b]
+        if not self.__intervals: return self.__chars.get
+        seen, classOf = dict(self.__chars), self.classOf
+        def classify ( c, default = 0 ):
+            try:
+                return seen[c]
+            except KeyError:
+                k = seen[c] = classOf(c, default)
+                return k
+        return classify
+
+    def classesOf ( self, chunk ):
+        '''
+        The classes of the characters in a str chunk, or of the bytes in a
+        bytes-like chunk.
+        '''
+        if isinstance(chunk, str):
+            classOf = self.classifier()
+            return [classOf(c, 0) for c in chunk]
+        if self.__byteClasses is None:
+            return [self.classOf(chr(b)) for b in bytes(chunk)]
+        return bytes(chunk).translate(self.__byteClasses)
+
+    def next ( self, state, event ):
+        return self.__table[state * self.__nclasses + self.classOf(event)]
+
+    def stepper ( self, chunk ):
+        '''
+        For Scanner: the events of chunk are its classes, and a
+        configuration is one state s, as the bit 1 << s so that those taken
+        make a set.
+        '''
+        table, accepting, nclasses, dead = self.__table, self.__accepting, self.__nclasses, CompiledDfa.DEAD
+        def step ( bit, k, taken ):
+            state = table[(bit.bit_length() - 1) * nclasses + k]
+            if state == dead or taken >> state & 1: return 0
+            return 1 << state
+        return self.classesOf(chunk), 1, 0, step, lambda bit: accepting[bit.bit_length() - 1]
+
+    def accept ( self, visitor ):
+        return visitor.visit(self)
+
+    @classmethod
+    def load ( c, buffer ):
+        '''
+        Reads a CompiledDfa written by SerializingVisitor. On little-endian
+        machines the transition table and the accepting flags are views
+        into the buffer, not copies, so an mmap of a rule file is shared
+        by every process that loads it.
+        '''
+        view = memoryview(buffer)
+        header = SerializingVisitor.HEADER
+        if len(view) < header.size:
+            raise SerializationException("Truncated header")
+        magic, version, flags, nstates, nclasses, nclassmap, nids = header.unpack_from(view)
+        if magic != SerializingVisitor.MAGIC:
+            raise SerializationException("Not a compiled DFA: %r" % magic)
+        if version != SerializingVisitor.VERSION:
+            raise SerializationException("Unsupported version %d" % version)
+
+        sections, offset = [], header.size
+        for length in (12 * nclassmap, 4 * nstates * nclasses, nstates,
+                       4 * (nstates + 1) if flags & SerializingVisitor.IDS else 0, 4 * nids):
+            sections.append(view[offset:offset+length])
+            offset += (length + 3) & ~3
+        if len(view) < offset:
+            raise SerializationException("Truncated data: %d bytes, %d expected" % (len(view), offset))
+        classmap, table, accepting, offsets, ids = sections
+
+        words, classes = c.__words(classmap), {}
+        for i in range(0, len(words), 3):
+            lo, hi, k = words[i], words[i+1], words[i+2]
+            classes[chr(lo) if lo == hi else CharClass(((lo, hi),))] = k
+        payloads = None
+        if flags & SerializingVisitor.IDS:
+            offsets, ids = c.__words(offsets), c.__words(ids)
+            payloads = tuple(frozenset(ids[offsets[s]:offsets[s+1]]) or False for s in range(nstates))
+        return c(classes, nclasses, c.__words(table, 'i'), accepting, payloads)
+
+    @classmethod
+    def open ( c, path ):
+        with open(path, 'rb') as f:
+            return c.load(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def __words ( view, typecode = 'I' ):
+        if sys.byteorder == 'little':
+            return view.cast(typecode)
+        words = array(typecode, view.tobytes())
+        words.byteswap()
+        return words
+
+
+class SerializingVisitor(object):
+    '''
+    Writes a CompiledDfa in a versioned binary format, all integers
+    little-endian and every section aligned on 4 bytes:
+
+        header      magic, version, flags, states, classes, class map
+                    entries and pattern ids (HEADER)
+        class map   (first, last code point, class) triples, 3 x uint32 each
+        table       states x classes int32 transitions
+        accepting   one byte per state
+        offsets     states + 1 uint32 offsets into ids, if flags has IDS
+        ids         the uint32 pattern ids accepted by every state
+
+    Only character and CharClass events can be written.
+    The bytes are returned, and also written to stream if one is given.
+    '''
+    MAGIC = b'RXDF'
+    VERSION = 2
+    IDS = 1
+    HEADER = struct.Struct('<4sHHIIII')
+
+    def __init__ ( self, stream = None ):
+        self.__stream = stream
+
+    def visit ( self, cdfa ):
+        nstates, nclasses = len(cdfa), cdfa.nclasses
+        try:
+            classmap = cdfa.ranges()
+        except TypeError:
+            raise SerializationException("Only character events can be serialized")
+
+        withIds = any(isinstance(p, (set, frozenset)) for p in cdfa.payloads)
+        offsets, ids = array('I', [0]), array('I')
+        if withIds:
+            for p in cdfa.payloads:
+                ids.extend(sorted(p) if p else ())
+                offsets.append(len(ids))
+
+        sections = [array('I', (v for triple in classmap for v in triple)), array('i', cdfa.table),
+                    bytes(cdfa.accepting), offsets if withIds else b'', ids]
+        data = bytearray(self.HEADER.pack(self.MAGIC, self.VERSION, self.IDS if withIds else 0,
+                                          nstates, nclasses, len(classmap), len(ids)))
+        for section in sections:
+            if isinstance(section, array) and sys.byteorder != 'little':
+                section = array(section.typecode, section)
+                section.byteswap()
+            data += bytes(section)
+            data += bytes(-len(data) & 3)
+        if self.__stream is not None:
+            self.__stream.write(data)
+        return bytes(data)
+
+
+class CompilingVisitor(object):
+    '''
+    Turns a DFA built by NfaToDfaVisitor into a CompiledDfa. Events whose
+    columns in the transition table are identical share a single class.
+    '''
+    def visit ( self, dfa ):
+        states, numbers = self.number(dfa.initial)
+        events = {e for s in states for e in s.next() if e != Automata.EPSILON}
+        columns = {}
+        for e in sorted(events, key=repr):
+            column = tuple(self.target(s, e, numbers) for s in states)
+            columns.setdefault(column, []).append(e)
+
+        classes = {}
+        for k, column in enumerate(columns, 1):
+            for e in columns[column]:
+                classes[e] = k
+
+        nclasses = len(columns) + 1
+        table = array('i', [CompiledDfa.DEAD]) * (len(states) * nclasses)
+        for column, k in zip(columns, range(1, nclasses)):
+            for s, target in enumerate(column):
+                table[s * nclasses + k] = target
+
+        accepting = bytes(1 if s.accepting else 0 for s in states)
+        return CompiledDfa(classes, nclasses, table, accepting, tuple(s.accepting for s in states))
+
+    def number ( self, initial ):
+        states, numbers = [initial], {initial: 0}
+        for state in states:    # grows while iterating: breadth-first order
+            for targets in state.next().values():
+                for s in targets:
+                    if s not in numbers:
+                        numbers[s] = len(states)
+                        states.append(s)
+        return states, numbers
+
+    def target ( self, state, event, numbers ):
+        targets = state.next(event)
+        return numbers[targets[0]] if any(targets) else CompiledDfa.DEAD
+
+
+class CompiledMatchingVisitor(object):
+    '''
+    Same matching semantics as MatchingVisitor, run directly on the
+    transition table of a CompiledDfa. Matchers that fall off the DFA are
+    dropped instead of lingering in the active list.
+    '''
+    def __init__ ( self, string, stats = None ):
+        self.__string = string
+        self.__matches = []
+        self.__stats = stats
+
+    def visit ( self, cdfa ):
+        string, matches = self.__string, []
+        self.__matches = matches
+        table, accepting, nclasses = cdfa.table, cdfa.accepting, cdfa.nclasses
+        dead = CompiledDfa.DEAD
+        started, transitions, matchers = time.perf_counter(), 0, 0
+        active = []
+        for i, k in enumerate(cdfa.classesOf(string)):
+            survivors = []
+            for state, beg in active:
+                state = table[state * nclasses + k]
+                if state != dead:
+                    if accepting[state]:
+                        matches.append(string[beg:i+1])
+                    survivors.append((state, beg))
+            state = table[k]
+            if state != dead:
+                if accepting[state]:
+                    matches.append(string[i:i+1])
+                survivors.append((state, i))
+                matchers += 1
+            transitions += len(survivors)
+            active = survivors
+
+        if self.__stats is not None:
+            self.__stats.transitions += transitions
+            self.__stats.matchers += matchers
+            self.__stats.times['match'] += time.perf_counter() - started
+        return matches
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+    def getMatches ( self ):
+        return self.__matches
+    matches = property(getMatches)
+
+
+class IncrementalMatcher(object):
+    '''
+    Keeps the matches of a CompiledDfa in a text being edited: the same
+    spans, in the same order, as CompiledMatchingVisitor finds in the
+    current text. Every interval characters the matchers alive, (state,
+    start) pairs with starts relative to the position, are saved as a
+    checkpoint. An edit rescans from the last checkpoint before it, and
+    stops at the first saved checkpoint past it where the matchers are
+    found again: everything after is the same as before but for being
+    shifted, so the scanning an edit costs grows with its size, not with
+    the size of the text; only the bookkeeping of the matches and
+    checkpoints after it is linear.
+    '''
+    def __init__ ( self, cdfa, text, interval = 1024 ):
+        self.__cdfa = cdfa
+        self.__text = text
+        self.__interval = interval
+        spans, positions, threads, r = self.scan(text, 0, (), (), ())
+        self.__spans = spans                # (end, start), in CompiledMatchingVisitor order
+        self.__positions = [0] + positions  # of checkpoints
+        self.__threads = [()] + threads     # alive at every checkpoint
+
+    def getText ( self ): return self.__text
+    text = property(getText)
+
+    def getInterval ( self ): return self.__interval
+    interval = property(getInterval)
+
+    def getSpans ( self ):
+        return [(start, end) for end, start in self.__spans]
+    spans = property(getSpans)
+
+    def findall ( self ):
+        text = self.__text
+        return [text[start:end] for end, start in self.__spans]
+
+    def append ( self, chunk ):
+        return self.edit(len(self.__text), len(self.__text), chunk)
+
+    def edit ( self, start, end, replacement ):
+        '''
+        Replaces text[start:end] with replacement, and returns the number
+        of characters rescanned.
+        '''
+        text, positions, threads = self.__text, self.__positions, self.__threads
+        if not 0 <= start <= end <= len(text):
+            raise IndexError("Edit %d:%d out of a text of %d" % (start, end, len(text)))
+        delta = len(replacement) - (end - start)
+        self.__text = text = text[:start] + replacement + text[end:]
+
+        k = bisect.bisect_right(positions, start) - 1
+        position = positions[k]
+        first = bisect.bisect_left(positions, end, k+1)     # saved checkpoints past the edit
+        resume = [p + delta for p in positions[first:]]
+        active = [(state, position + offset) for state, offset in threads[k]]
+        spans, newPositions, newThreads, r = self.scan(text, position, active, resume, threads[first:])
+
+        stop = resume[r] if r < len(resume) else len(text)
+        kept = bisect.bisect_right(self.__spans, (position, sys.maxsize))
+        later = bisect.bisect_right(self.__spans, (stop - delta, sys.maxsize))
+        self.__spans = self.__spans[:kept] + spans + \
+                       [(e + delta, s + delta) for e, s in self.__spans[later:]]
+        self.__positions = positions[:k+1] + newPositions + resume[r:]
+        self.__threads = threads[:k+1] + newThreads + threads[first+r:]
+        return stop - position
+
+    def scan ( self, text, position, active, resume, saved ):
+        '''
+        Runs the matchers active at position up to the end of text, or up
+        to the first of the resume positions where they are the saved
+        ones again. Returns the spans found, the new checkpoints and the
+        index in resume where the scan stopped.
+        '''
+        cdfa, interval = self.__cdfa, self.__interval
+        table, accepting, nclasses = cdfa.table, cdfa.accepting, cdfa.nclasses
+        classOf = cdfa.classifier(text)
+        dead, spans, positions, threads, r = CompiledDfa.DEAD, [], [], [], 0
+        for i in range(position, len(text)):
+            if i > position:
+                while r < len(resume) and resume[r] < i: r += 1
+                if r < len(resume) and resume[r] == i and \
+                   saved[r] == tuple((state, start - i) for state, start in active):
+                    return spans, positions, threads, r
+                if i % interval == 0:
+                    positions.append(i)
+                    threads.append(tuple((state, start - i) for state, start in active))
+            k = classOf(text[i], 0)
+            survivors = []
+            for state, start in active:
+                state = table[state * nclasses + k]
+                if state != dead:
+                    if accepting[state]: spans.append((i+1, start))
+                    survivors.append((state, start))
+            state = table[k]
+            if state != dead:
+                if accepting[state]: spans.append((i+1, i))
+                survivors.append((state, i))
+            active = survivors
+        return spans, positions, threads, len(resume)
+
+
+class Scanner(object):
+    '''
+    Leftmost-longest, non-overlapping search, fed one chunk of input at a
+    time and yielding the (start, end) spans of non-empty matches, as
+    absolute offsets, as soon as they become final. Matches may span any
+    number of chunks. It runs any automata with a stepper, a CompiledDfa,
+    a ShiftAndAutomata, a PikeVm or a CountingAutomata: stepper(chunk)
+    gives the events of the items of chunk, the configurations a thread
+    starts in, an empty set of them, a step function from the
+    configurations of a thread, an event and the configurations already
+    taken by threads started earlier to the ones left, and whether
+    configurations accept.
+
+    Every matcher thread belongs to a search, the search for the first
+    match starting at or after the end of the previous one, and remembers
+    where it started. Threads in the same configuration have the same
+    future, so each configuration is only kept by the thread that started
+    first: there are never more threads than configurations, which makes
+    the scan O(n) in the length of the input for a DFA, O(n*m) for m
+    positions or states. Once a search has a match, threads starting after
+    it are dropped, and threads starting at or after its end feed the next
+    search; when the match grows, those later searches are discarded,
+    since they overlap it. With candidates, the ascending positions where
+    a match may start, threads only start there, and the scan skips to the
+    next one whenever no thread is alive.
+    '''
+    def __init__ ( self, automata, candidates = None ):
+        self.__automata = automata
+        self.__offset = 0
+        self.__threads = []                         # [configurations, start, search], sorted by start
+        self.__searches = deque([[0, None, None]])  # [begin, match start, match end]
+        self.__candidates = None if candidates is None else iter(candidates)
+        self.__candidate = None if candidates is None else next(self.__candidates, None)
+
+    def getOffset ( self ): return self.__offset
+    offset = property(getOffset)
+
+    def feed ( self, chunk ):
+        events, initial, nothing, step, accepts = self.__automata.stepper(chunk)
+        threads, searches, candidates = self.__threads, self.__searches, self.__candidates
+        offset, j = self.__offset, 0
+        while j < len(events):
+            i = offset + j
+            last = searches[-1]
+            if last[1] is not None and i >= last[2]:
+                last = [last[2], None, None]
+                searches.append(last)
+            if last[1] is None:
+                if candidates is None:
+                    threads.append([initial, i, last])
+                else:
+                    while self.__candidate is not None and self.__candidate < i:
+                        self.__candidate = next(candidates, None)
+                    if self.__candidate == i:
+                        threads.append([initial, i, last])
+                    elif not threads:   # skip to the next candidate
+                        if self.__candidate is None: break
+                        j = self.__candidate - offset
+                        continue
+
+            event, survivors, taken = events[j], [], nothing
+            for thread in threads:
+                configurations, start, search = thread
+                if search[0] is None: continue  # discarded search
+                configurations = step(configurations, event, taken)
+                if not configurations: continue
+                if accepts(configurations) and (search[1] is None or start <= search[1]):
+                    search[1], search[2] = start, i+1
+                    while searches[-1] is not search:
+                        searches.pop()[0] = None
+                elif search[1] is not None and start > search[1]:
+                    continue
+                taken = taken | configurations
+                thread[0] = configurations
+                survivors.append(thread)
+            threads = self.__threads = survivors
+
+            while searches[0][1] is not None and not (threads and threads[0][2] is searches[0]):
+                begin, start, end = searches.popleft()
+                yield start, end
+                if not searches: searches.append([end, None, None])
+            j += 1
+        self.__offset += len(chunk)
+
+    def finish ( self ):
+        for begin, start, end in self.__searches:
+            if start is not None: yield start, end
+        self.__threads = []
+        self.__searches = deque([[self.__offset, None, None]])
+
+
+class SearchingVisitor(object):
+    '''
+    Runs a Scanner over a whole string, from candidates only if given.
+    '''
+    def __init__ ( self, string, candidates = None ):
+        self.__string = string
+        self.__candidates = candidates
+
+    def visit ( self, automata ):
+        scanner = Scanner(automata, self.__candidates)
+        for span in scanner.feed(self.__string): yield span
+        for span in scanner.finish(): yield span
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+
+class StreamingVisitor(object):
+    '''
+    Runs a Scanner over an input that doesn't need to fit in memory: an
+    iterable of str or bytes chunks, a binary file object, or a buffer
+    such as bytes or an mmap, which is read through memoryview slices.
+    Bytes are matched as latin-1 characters.
+    '''
+    def __init__ ( self, source, chunkSize = 1 << 16 ):
+        self.__source = source
+        self.__chunkSize = chunkSize
+
+    def visit ( self, cdfa ):
+        scanner = Scanner(cdfa)
+        for chunk in self.chunks():
+            for span in scanner.feed(chunk): yield span
+        for span in scanner.finish(): yield span
+
+    def chunks ( self ):
+        source, size = self.__source, self.__chunkSize
+        if isinstance(source, str):
+            yield source
+        elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            view = memoryview(source)
+            for offset in range(0, len(view), size):
+                yield view[offset:offset+size]
+        elif hasattr(source, 'read'):
+            chunk = source.read(size)
+            while chunk:
+                yield chunk
+                chunk = source.read(size)
+        else:
+            for chunk in source:
+                yield chunk
+
+    def getSource ( self ):
+        return self.__source
+    source = property(getSource)
+
+
+class SetMatchingVisitor(object):
+    '''
+    Single pass over a string with the CompiledDfa of a PatternSet, or of a
+    Pattern as pattern 0, yielding (pattern id, start, end) for every
+    position where a match of some pattern ends, with the leftmost start
+    among the matches of that pattern ending there. Threads in the same
+    DFA state are merged keeping the one that started first, since they
+    have the same future.
+    '''
+    def __init__ ( self, string ):
+        self.__string = string
+
+    def visit ( self, cdfa ):
+        table, accepting, nclasses = cdfa.table, cdfa.accepting, cdfa.nclasses
+        payloads = cdfa.ids
+        dead = CompiledDfa.DEAD
+        threads = []    # [state, start], sorted by start
+        for i, k in enumerate(cdfa.classesOf(self.__string)):
+            threads.append([0, i])
+            survivors, seen, reported = [], set(), set()
+            for thread in threads:
+                state = table[thread[0] * nclasses + k]
+                if state == dead or state in seen: continue
+                if accepting[state]:
+                    for pid in sorted(payloads[state] - reported):
+                        yield pid, thread[1], i+1
+                    reported.update(payloads[state])
+                seen.add(state)
+                thread[0] = state
+                survivors.append(thread)
+            threads = survivors
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+
+class BatchMatchingVisitor(object):
+    '''
+    Matches many strings, all str or all bytes, against a CompiledDfa at
+    the start of each string. With full set, the result tells whether
+    each whole string matches; otherwise it is the end of the longest
+    match at the start of each string, -1 for none.
+
+    With NumPy, the strings are advanced in lockstep: their characters are
+    mapped to classes in one go and every step is a single fancy-indexing
+    lookup in the transition table for all the strings still alive, so the
+    interpreter runs once per character position rather than once per
+    character, and the result is a NumPy array. Without it, the strings
+    are matched one after the other and the result is a list.
+    '''
+    def __init__ ( self, strings, full = False ):
+        self.__strings = list(strings)
+        self.__full = full
+
+    def visit ( self, cdfa ):
+        if numpy is None:
+            return [self.matchOne(cdfa, s) for s in self.__strings]
+        return self.matchAll(cdfa)
+
+    def matchOne ( self, cdfa, string ):
+        table, accepting, nclasses = cdfa.table, cdfa.accepting, cdfa.nclasses
+        state, end = 0, 0 if accepting[0] else -1
+        for i, k in enumerate(cdfa.classesOf(string)):
+            state = table[state * nclasses + k]
+            if state == CompiledDfa.DEAD:
+                return False if self.__full else end
+            if accepting[state]: end = i+1
+        return bool(accepting[state]) if self.__full else end
+
+    def matchAll ( self, cdfa ):
+        strings, nclasses = self.__strings, cdfa.nclasses
+        table = numpy.asarray(cdfa.table, dtype=numpy.int32)
+        accepting = numpy.frombuffer(bytes(cdfa.accepting), dtype=numpy.uint8).astype(bool)
+        lengths = numpy.fromiter(map(len, strings), dtype=numpy.int64, count=len(strings))
+        starts = numpy.zeros(len(strings), dtype=numpy.int64)
+        numpy.cumsum(lengths[:-1], out=starts[1:])
+        codes = self.classesOf(cdfa, strings)
+
+        states = numpy.zeros(len(strings), dtype=numpy.int32)
+        ends = numpy.full(len(strings), 0 if accepting[0] else -1, dtype=numpy.int64)
+        for j in range(int(lengths.max()) if len(strings) else 0):
+            live = numpy.flatnonzero((lengths > j) & (states != CompiledDfa.DEAD))
+            if not live.size: break
+            reached = table[states[live] * nclasses + codes[starts[live] + j]]
+            states[live] = reached
+            if not self.__full:
+                ends[live[(reached != CompiledDfa.DEAD) & accepting[reached]]] = j+1
+        if self.__full:
+            return (states != CompiledDfa.DEAD) & accepting[states]
+        return ends
+
+    @staticmethod
+    def classesOf ( cdfa, strings ):
+        if strings and not isinstance(strings[0], str):
+            return numpy.frombuffer(cdfa.classesOf(b''.join(strings)), dtype=numpy.uint8) \
+                if cdfa.byteClasses is not None else numpy.array(cdfa.classesOf(b''.join(strings)))
+        points = numpy.frombuffer(''.join(strings).encode('utf-32-le'), dtype=numpy.uint32)
+        ranges = cdfa.ranges()
+        if not ranges: return numpy.zeros(len(points), dtype=numpy.int64)
+        lows, highs, values = (numpy.array(column, dtype=numpy.int64) for column in zip(*ranges))
+        found = numpy.searchsorted(lows, points, side='right') - 1
+        clipped = numpy.maximum(found, 0)
+        return numpy.where((found >= 0) & (points <= highs[clipped]), values[clipped], 0)
+
+    def getStrings ( self ):
+        return self.__strings
+    strings = property(getStrings)
+
+
+class ParallelMatchingVisitor(object):
+    '''
+    Same output as SetMatchingVisitor, computed by splitting the string in
+    segments scanned concurrently by an executor, a process pool unless
+    one is given.
+
+    A segment doesn't know which DFA states are active when it begins, so
+    it is scanned from all of them at once: every thread carries the set
+    of DFA states, or origins, it may have come from when the segment
+    began, and the leftmost start of the threads started inside the
+    segment. Threads in the same state merge their origins and keep the
+    leftmost start. Segments are then stitched in order: knowing the
+    earliest start of every state active at the end of a segment maps the
+    origins of the next one to actual starts, threads whose origins were
+    not active falling back to their own start.
+    '''
+    def __init__ ( self, string, workers = None, executor = None, minSegment = 1 << 16 ):
+        self.__string = string
+        self.__workers = workers or 1
+        self.__executor = executor
+        self.__minSegment = minSegment
+
+    def visit ( self, cdfa ):
+        string = self.__string
+        count = max(1, min(self.__workers, len(string) // self.__minSegment))
+        size = -(-len(string) // count) or 1
+        segments = [(string[o:o+size], o) for o in range(0, len(string), size)]
+        if self.__executor is not None:
+            results = [self.__executor.submit(ParallelMatchingVisitor.scanSegment, cdfa, seg, o)
+                       for seg, o in segments]
+            results = [r.result() for r in results]
+        else:
+            data = cdfa.accept(SerializingVisitor())
+            with ProcessPoolExecutor(self.__workers) as pool:
+                results = list(pool.map(ParallelMatchingVisitor.scanSegment,
+                                        [data] * len(segments), *zip(*segments)))
+        return self.stitch(cdfa, results)
+
+    @staticmethod
+    def scanSegment ( cdfa, segment, offset ):
+        if not isinstance(cdfa, CompiledDfa):
+            cdfa = CompiledDfa.load(cdfa)
+        table, accepting, nclasses = cdfa.table, cdfa.accepting, cdfa.nclasses
+        dead = CompiledDfa.DEAD
+        threads = {q: (frozenset((q,)), None) for q in range(len(cdfa))}
+        reports = []
+        for i, k in enumerate(cdfa.classesOf(segment), offset):
+            origins, start = threads.get(0, (frozenset(), None))
+            threads[0] = (origins, i if start is None else start)
+            survivors = {}
+            for state, (origins, start) in threads.items():
+                state = table[state * nclasses + k]
+                if state == dead: continue
+                try:
+                    merged, earliest = survivors[state]
+                    survivors[state] = (merged | origins, start if earliest is None else
+                                        earliest if start is None else min(start, earliest))
+                except KeyError:
+                    survivors[state] = (origins, start)
+            threads = survivors
+            ends = [(state, origins, start) for state, (origins, start) in threads.items()
+                    if accepting[state]]
+            if ends: reports.append((i+1, ends))
+        return reports, threads
+
+    def stitch ( self, cdfa, results ):
+        ids = cdfa.ids
+        active = {}     # earliest start of every state active at the end of the last segment
+        def resolve ( origins, start ):
+            starts = [active[q] for q in origins if q in active]
+            return min(starts) if starts else start
+
+        for reports, threads in results:
+            for end, ends in reports:
+                best = {}
+                for state, origins, start in ends:
+                    start = resolve(origins, start)
+                    if start is None: continue
+                    for pid in ids[state]:
+                        if pid not in best or start < best[pid]: best[pid] = start
+                for start, pid in sorted((start, pid) for pid, start in best.items()):
+                    yield pid, start, end
+            active = {state: resolve(origins, start) for state, (origins, start) in threads.items()}
+            active = {state: start for state, start in active.items() if start is not None}
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+
 class Parser(object):
 
-    def __init__ ( self, oper = ('(', ')', '|', '\0', '*', '+',) ):
+    class Node(object):
+        '''
+        Syntax tree node, as built by TreeVisitor: an event leaf, or an
+        operator applied to its children.
+        '''
+        __slots__ = ('operator', 'children', 'event')
+
+        def __init__ ( self, operator = None, children = (), event = None ):
+            self.operator = operator
+            self.children = children
+            self.event = event
+
+        def __repr__ ( self ):
+            if self.operator is None: return str(self.event)
+            return "(%r %s)" % (self.operator, ' '.join(map(repr, self.children)))
+
+        def postorder ( self ):
+            '''
+            Every node of the tree, children before their parent, without
+            recursing: concatenation chains are as deep as they are long.
+            '''
+            pending, result = [self], []
+            while pending:
+                node = pending.pop()
+                result.append(node)
+                pending.extend(node.children)
+            return reversed(result)
+
+        def rebuild ( self, build ):
+            '''
+            A new tree, built bottom-up: build(node, children) returns what
+            stands for node, given what stands for its children.
+            '''
+            built = {}
+            for node in self.postorder():
+                built[node] = build(node, tuple(built[child] for child in node.children))
+            return built[self]
+
+        def clone ( self ):
+            return self.rebuild(lambda node, children: Parser.Node(node.operator, children, node.event))
+
+        def reverse ( self ):
+            '''
+            The tree of the reversed pattern: concatenations swapped.
+            '''
+            return self.rebuild(lambda node, children: \
+                Parser.Node(node.operator, children[::-1] if node.operator == '\0' else children, node.event))
+
+        def counted ( self ):
+            return any(isinstance(node.operator, Repeat) for node in self.postorder())
+
+        def positions ( self ):
+            '''
+            The number of events of this tree once counted repetitions are
+            unrolled, without unrolling them.
+            '''
+            sizes = {}
+            for node in self.postorder():
+                size = sum(sizes[child] for child in node.children) if node.children else 1
+                if isinstance(node.operator, Repeat):
+                    size *= max(node.operator.min, 1) if node.operator.max is None else node.operator.max
+                sizes[node] = size
+            return sizes[self]
+
+        def expand ( self ):
+            '''
+            This tree with counted repetitions unrolled into copies of their
+            operand, the optional ones under '?' nodes, for the engines
+            without counters.
+            '''
+            if not self.counted(): return self
+            def build ( node, children ):
+                if not isinstance(node.operator, Repeat):
+                    return Parser.Node(node.operator, children, node.event)
+                low, high = node.operator.min, node.operator.max
+                count = max(low, 1) if high is None else high
+                copies = [children[0]] + [children[0].clone() for i in range(count - 1)]
+                if high is None:
+                    parts = copies[:-1] + [Parser.Node('+' if low else '*', (copies[-1],))]
+                else:
+                    parts = copies[:low] + [Parser.Node('?', (copy,)) for copy in copies[low:]]
+                return reduce(lambda a, b: Parser.Node('\0', (a, b)), parts)
+            return self.rebuild(build)
+
+        def accept ( self, visitor ):
+            return visitor.visit(self)
+
+    def __init__ ( self, oper = ('(', ')', '|', '\0', '*', '+',), factory = None ):
         self.__operators = oper
         self.__operandStack = deque()
         self.__operatorStack = deque()
         self.__inputSet = set()
+        self.__factory = factory or Automata.State
+
+    def newState ( self ):
+        return self.__factory()
 
     def isOperator ( self, token ):
-        return token in self.__operators
+        return isinstance(token, Repeat) or token in self.__operators
 
     def isEvent ( self, token ):
+        if isinstance(token, CharClass): return True
         try:
             return token.isalnum() and not self.isOperator(token)
         except:
             return False
             
     def isUnaryOperator ( self, token ):
-        return self.isOperator(token) and token in ('*', '+')
+        return isinstance(token, Repeat) or self.isOperator(token) and token in ('*', '+')
     
     def isBinaryOperator ( self, token ):
         return self.isOperator(token) and not self.isUnaryOperator(token)
 
     def precedence ( self, opl, opr ):
-        return self.__operators.index(opl) <= self.__operators.index(opr)
+        rank = lambda op: self.__operators.index('*' if isinstance(op, Repeat) else op)
+        return rank(opl) <= rank(opr)
         
     def entersNest ( self, token ):
         return token == self.__operators[0]
@@ -220,13 +1965,15 @@ class Parser(object):
                 
     def push ( self, token ):
         if self.isEvent(token):
-            s0, s1 = Automata.State(), Automata.State()
+            s0, s1 = self.newState(), self.newState()
             s0.addTransition(token, s1);
             nfa = [s0, s1]
             self.__inputSet.add(token)
             self.__operandStack.append(nfa)
         elif self.isOperator(token):
             self.__operatorStack.append(token)
+        elif isinstance(token, Parser.Node):
+            self.__operandStack.append(token)
         else:
             try:
                 any(token) and token[0].addTransition and token[-1].addTransition
@@ -252,15 +1999,54 @@ class Parser(object):
 
         if syntax:
             last = None
-            for token in syntax:
+            for token in self.tokens(syntax):
                 if isConcat(last, token): yield chr(0)
                 last = token
                 yield token
+
+    def tokens ( self, syntax ):
+        '''
+        The characters of syntax, but for bracketed classes, [a-z0-9] or
+        negated [^a-z], and '.', which become CharClass events, and for
+        counted repetitions {m}, {m,} and {m,n}, which become Repeat
+        operators.
+        '''
+        i = 0
+        while i < len(syntax):
+            token = syntax[i]
+            if token == '.':
+                token = CharClass.DOT
+            elif token == '[':
+                start = i + 2 if syntax.startswith('^', i+1) else i + 1
+                end = syntax.find(']', start + 1)   # a leading ']' is a member
+                if end < 0:
+                    raise PatternSyntaxException("Unterminated class at %d in %r" % (i, syntax))
+                token = CharClass.parse(syntax[start:end], start == i + 2)
+                i = end
+            elif token == '{':
+                end = syntax.find('}', i)
+                if end < 0:
+                    raise PatternSyntaxException("Unterminated repetition at %d in %r" % (i, syntax))
+                token = Repeat.parse(syntax[i+1:end])
+                i = end
+            i += 1
+            yield token
                 
+    def reset ( self ):
+        '''
+        Empties the stacks, e.g. of what a failed accept left behind, so
+        that a Parser can be reused; it still serves one thread at a time.
+        '''
+        self.__operandStack.clear()
+        self.__operatorStack.clear()
+        self.__inputSet.clear()
+
     def accept ( self, visitor, syntax = None ):
+        if syntax is not None: self.reset()     # else, run what was pushed by hand
+        event = getattr(visitor, 'event', None)     # visitors may build their own operands
         for token in self.tokenGenerator(syntax):
             if self.isEvent(token):
-                self.push(token)
+                self.push(token if event is None else event(token))
             #elif len(self.__operatorStack) == 0:   I think this is not needed
             #    self.pushOp(token)
             elif self.entersNest(token):
@@ -279,14 +2065,769 @@ class Parser(object):
             visitor.visit(self)
                   
         nfa = self.pop()
+        if isinstance(nfa, Parser.Node): return nfa
         nfa[-1].accepting = True
         return nfa
         
 
+class TreeVisitor(object):
+    '''
+    Builds the syntax tree of a pattern out of Parser.Node objects instead
+    of an NFA: parser.accept(TreeVisitor(), syntax) returns its root.
+    '''
+    def event ( self, token ):
+        return Parser.Node(event=token)
+
+    def visit ( self, parser ):
+        operator = parser.popOp()
+        if not parser.isOperator(operator):
+            raise NotAnOperatorException(operator)
+
+        if parser.isUnaryOperator(operator):
+            children = (parser.pop(),)
+        elif operator in ('|', '\0'):
+            nodeB, nodeA = parser.pop(), parser.pop()   # Pop order matters: AB != BA
+            children = (nodeA, nodeB)
+        else:
+            raise UnknownOperatorException(operator)
+        parser.push(Parser.Node(operator, children))
+
+
+class LiteralVisitor(object):
+    '''
+    Extracts from a syntax tree the literals its matches are made of, as
+    sets of alternative strings: every match starts with one of the
+    prefixes, and contains one of the factors. For every node it works
+    out the strings it matches exactly, if few, and its prefixes,
+    suffixes and factors, None meaning unknown; sets growing beyond LIMIT
+    strings are dropped. The result is a Prefilter.
+    '''
+    LIMIT = 16
+
+    def visit ( self, tree ):
+        info = {}
+        for node in tree.postorder():
+            if node.operator is None:
+                literal = node.event
+                if isinstance(literal, CharClass):
+                    literal = frozenset(literal.chars()) if literal.size() <= self.LIMIT else None
+                else:
+                    literal = frozenset((literal,))
+                info[node] = (literal, literal, literal, literal)
+            elif node.operator == '\0':
+                (eA, pA, sA, fA), (eB, pB, sB, fB) = info[node.children[0]], info[node.children[1]]
+                exact = self.cross(eA, eB)
+                info[node] = (exact, self.cross(eA, pB) or pA, self.cross(sA, eB) or sB,
+                              self.best(fA, fB, self.cross(sA, pB), exact))
+            elif node.operator == '|':
+                a, b = info[node.children[0]], info[node.children[1]]
+                info[node] = tuple(self.union(x, y) for x, y in zip(a, b))
+            elif node.operator == '+' or isinstance(node.operator, Repeat) and node.operator.min > 0:
+                exact, prefixes, suffixes, factors = info[node.children[0]]
+                info[node] = (None, prefixes, suffixes, factors)
+            else:   # may match the empty string: nothing is required
+                info[node] = (None, None, None, None)
+        exact, prefixes, suffixes, factors = info[tree]
+        return Prefilter(prefixes, factors)
+
+    def cross ( self, a, b ):
+        if a is None or b is None or len(a) * len(b) > self.LIMIT: return None
+        return frozenset(x + y for x in a for y in b)
+
+    def union ( self, a, b ):
+        if a is None or b is None or len(a) + len(b) > self.LIMIT: return None
+        return a | b
+
+    def best ( self, *literals ):
+        literals = [l for l in literals if l]
+        if not literals: return None
+        return max(literals, key=lambda l: (min(map(len, l)), -len(l)))
+
+
+class Prefilter(object):
+    '''
+    Literals found by LiteralVisitor: every match starts with one of the
+    prefixes and contains one of the factors, either being None if not
+    known. Works on str and, reading literals as latin-1, on bytes.
+    '''
+    def __init__ ( self, prefixes, factors ):
+        self.__prefixes = prefixes
+        self.__factors = factors
+
+    def __repr__ ( self ):
+        return "Prefilter(%r, %r)" % (self.__prefixes and sorted(self.__prefixes),
+                                      self.__factors and sorted(self.__factors))
+
+    def getPrefixes ( self ): return self.__prefixes
+    prefixes = property(getPrefixes)
+
+    def getFactors ( self ): return self.__factors
+    factors = property(getFactors)
+
+    def literals ( self, literals, string ):
+        '''
+        The literals to look for in string: for bytes, those that encode as
+        latin-1, as no other can occur.
+        '''
+        if isinstance(string, str): return literals
+        encoded = []
+        for l in literals:
+            try:
+                encoded.append(l.encode('latin-1'))
+            except UnicodeEncodeError:
+                pass
+        return encoded
+
+    def rejects ( self, string ):
+        '''
+        Whether string certainly holds no match.
+        '''
+        if not self.__factors: return False
+        return not any(f in string for f in self.literals(self.__factors, string))
+
+    def candidates ( self, string ):
+        '''
+        Every position where one of the prefixes starts, in order.
+        '''
+        heap = []
+        for prefix in self.literals(self.__prefixes, string):
+            position = string.find(prefix)
+            if position >= 0: heap.append((position, prefix))
+        heapq.heapify(heap)
+        last = -1
+        while heap:
+            position, prefix = heap[0]
+            if position > last:
+                yield position
+                last = position
+            following = string.find(prefix, position + 1)
+            if following >= 0:
+                heapq.heapreplace(heap, (following, prefix))
+            else:
+                heapq.heappop(heap)
+
+
+class PrefilteredSearchingVisitor(object):
+    '''
+    Same spans as SearchingVisitor, for patterns whose matches all start
+    with one of the prefixes of a Prefilter: the string is searched for
+    those with str.find or bytes.find, and matchers of the DFA only start
+    from the positions where they occur, merged as in Scanner, so the
+    scan stays linear however dense the candidates. The stretches where
+    no matcher is alive are skipped.
+    '''
+    def __init__ ( self, string, prefilter ):
+        self.__string = string
+        self.__prefilter = prefilter
+
+    def visit ( self, cdfa ):
+        string, prefilter = self.__string, self.__prefilter
+        if prefilter.rejects(string): return iter(())
+        return cdfa.accept(SearchingVisitor(string, prefilter.candidates(string)))
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+
+class ShiftAndAutomata(object):
+    '''
+    Glushkov position automaton of a pattern, run bit-parallel. Each
+    occurrence of an event in the pattern is a position, bit p of an int
+    standing for position p and bit 0 for the initial state; a set of
+    active positions steps on an event with
+        (((D << 1) & shift) | follow(D)) & masks[event]
+    where shift holds the p -> p+1 moves of concatenations, and follow(D)
+    the other ones, looked up 8 positions at a time in tables, of which a
+    plain concatenation has none. Built in time linear in the pattern,
+    whatever the size of its DFA; worth it up to MAX_POSITIONS positions.
+    '''
+    MAX_POSITIONS = 64
+
+    def __init__ ( self, symbols, first, last, follow, nullable = False ):
+        self.__symbols = tuple(symbols)
+        self.__nullable = nullable
+        self.__first = first
+        self.__last = last
+        self.__follow = tuple(follow)   # follow[p-1]: positions following position p
+        self.__reverse = None
+        self.__masks = {}
+        for p, symbol in enumerate(self.__symbols, 1):
+            self.__masks[symbol] = self.__masks.get(symbol, 0) | 1 << p
+        self.__shift = self.__tables = None
+
+    def __len__ ( self ):
+        return len(self.__symbols)
+
+    def program ( self ):
+        '''
+        The shift mask and follow tables, built on first use only, as
+        FollowposVisitor needs none of them.
+        '''
+        if self.__tables is None:
+            moves = (self.__first,) + self.__follow
+            shift = 0
+            for p, targets in enumerate(moves):
+                shift |= targets & 1 << (p+1)
+            others = [targets & ~(1 << (p+1)) for p, targets in enumerate(moves)]
+            tables = []
+            for offset in range(0, len(moves), 8):
+                table = [0] * 256
+                for byte in range(1, 256):
+                    low = (byte & -byte).bit_length() - 1
+                    if offset + low < len(others):
+                        table[byte] = table[byte & (byte-1)] | others[offset + low]
+                if any(table): tables.append((offset, table))
+            self.__shift, self.__tables = shift, tuple(tables)
+        return self.__shift, self.__tables
+
+    def getSymbols ( self ): return self.__symbols
+    symbols = property(getSymbols)
+
+    def getFirst ( self ): return self.__first
+    first = property(getFirst)
+
+    def getLast ( self ): return self.__last
+    last = property(getLast)
+
+    def getFollow ( self ): return self.__follow
+    follow = property(getFollow)
+
+    def getNullable ( self ): return self.__nullable
+    nullable = property(getNullable)
+
+    def getReverse ( self ):
+        '''
+        The automaton of the reversed pattern, positions numbered from the
+        end so that its concatenations shift too.
+        '''
+        if self.__reverse is None:
+            size = len(self.__symbols)
+            mirror = lambda bits: sum(1 << (size+1-p) for p in range(1, size+1) if bits >> p & 1)
+            follow = [0] * size
+            for p, targets in enumerate(self.__follow, 1):
+                for q in range(1, size+1):
+                    if targets >> q & 1: follow[size-q] |= 1 << (size+1-p)
+            self.__reverse = ShiftAndAutomata(self.__symbols[::-1], mirror(self.__last),
+                                              mirror(self.__first), follow, self.__nullable)
+        return self.__reverse
+    reverse = property(getReverse)
+
+    def maskOf ( self, c, default = 0 ):
+        '''
+        The positions of character c: those of c itself and of the
+        CharClass events holding it.
+        '''
+        mask = self.__masks.get(c, 0)
+        for event, positions in self.__masks.items():
+            if isinstance(event, CharClass) and c in event: mask |= positions
+        return mask or default
+
+    def masksOf ( self, string ):
+        '''
+        A function from the items of string, characters or for bytes
+        their latin-1 codes, and a default, to their masks.
+        '''
+        if isinstance(string, str):
+            if not any(isinstance(e, CharClass) for e in self.__masks): return self.__masks.get
+            masks, maskOf = {}, self.maskOf
+            def mask ( c, default = 0 ):
+                try:
+                    return masks[c]
+                except KeyError:
+                    result = masks[c] = maskOf(c, default)
+                    return result
+            return mask
+        return {b: self.maskOf(chr(b)) for b in range(256)}.get
+
+    def starts ( self, string ):
+        '''
+        Every position where a match starts, ascending: the reversed
+        pattern is run backwards, unanchored, over the whole string.
+        '''
+        reverse = self.reverse
+        masks, last = reverse.masksOf(string), reverse.__last
+        shift, tables = reverse.program()
+        starts, active = [], 0
+        for i in range(len(string)-1, -1, -1):
+            active |= 1
+            following = (active << 1) & shift
+            for offset, table in tables:
+                following |= table[active >> offset & 255]
+            active = following & masks(string[i], 0)
+            if active & last: starts.append(i)
+        starts.reverse()
+        return starts
+
+    def stepper ( self, chunk ):
+        '''
+        For Scanner: the events of chunk are its items, and configurations
+        are sets of positions.
+        '''
+        masks, last = self.masksOf(chunk), self.__last
+        shift, tables = self.program()
+        def step ( active, c, taken ):
+            following = (active << 1) & shift
+            for offset, table in tables:
+                following |= table[active >> offset & 255]
+            return following & masks(c, 0) & ~taken
+        return chunk, 1, 0, step, lambda active: bool(active & last)
+
+    def ends ( self, string, start ):
+        '''
+        Every end of a match starting at start, ascending.
+        '''
+        masks, last = self.masksOf(string), self.__last
+        shift, tables = self.program()
+        active = 1
+        for i in range(start, len(string)):
+            following = (active << 1) & shift
+            for offset, table in tables:
+                following |= table[active >> offset & 255]
+            active = following & masks(string[i], 0)
+            if not active: break
+            if active & last: yield i+1
+
+    def accept ( self, visitor ):
+        return visitor.visit(self)
+
+
+class GlushkovVisitor(object):
+    '''
+    Builds the ShiftAndAutomata of a syntax tree from the nullable, first
+    and last positions of its nodes, linking the last positions of a
+    concatenation's left side, or of a repeated node, to the first ones
+    that can follow them. Counted repetitions are unrolled.
+    '''
+    def visit ( self, tree ):
+        tree = tree.expand()
+        symbols, follow, info = [], [], {}
+        for node in tree.postorder():
+            if node.operator is None:
+                symbols.append(node.event)
+                follow.append(0)
+                position = 1 << len(symbols)
+                info[node] = (False, position, position)
+            elif node.operator == '\0':
+                (nullableA, firstA, lastA), (nullableB, firstB, lastB) = \
+                    info[node.children[0]], info[node.children[1]]
+                self.link(follow, lastA, firstB)
+                info[node] = (nullableA and nullableB,
+                              firstA | firstB if nullableA else firstA,
+                              lastA | lastB if nullableB else lastB)
+            elif node.operator == '|':
+                (nullableA, firstA, lastA), (nullableB, firstB, lastB) = \
+                    info[node.children[0]], info[node.children[1]]
+                info[node] = (nullableA or nullableB, firstA | firstB, lastA | lastB)
+            elif node.operator == '?':
+                nullable, first, last = info[node.children[0]]
+                info[node] = (True, first, last)
+            else:
+                nullable, first, last = info[node.children[0]]
+                self.link(follow, last, first)
+                info[node] = (nullable or node.operator == '*', first, last)
+        nullable, first, last = info[tree]
+        return ShiftAndAutomata(symbols, first, last, follow, nullable)
+
+    def link ( self, follow, sources, targets ):
+        for p in Automata.Index.positionsOf(sources):
+            follow[p-1] |= targets
+
+
+class FollowposVisitor(object):
+    '''
+    Builds the DFA of a syntax tree directly, Dragon Book style, without
+    an epsilon NFA: a DFA state is a set of positions of the tree, as an
+    int bitset like in ShiftAndAutomata, bit 0 standing for the start,
+    and its move on an event is the followpos of its positions, from
+    GlushkovVisitor, restricted to the positions of that event. The result
+    is an Automata like the one of NfaToDfaVisitor. With maxStates set,
+    raises StateBudgetException as soon as the DFA grows beyond that many
+    states.
+    '''
+    def __init__ ( self, stats = None, maxStates = None ):
+        self.__stats = stats
+        self.__maxStates = maxStates
+
+    def visit ( self, tree ):
+        return self.determinize(tree.accept(GlushkovVisitor()))
+
+    def determinize ( self, glushkov ):
+        if self.__stats is None: return self.subsets(glushkov)
+        with self.__stats.timer('subset'):
+            return self.subsets(glushkov)
+
+    def subsets ( self, glushkov ):
+        masks, labels = {}, [()]   # the events of the DFA and of every position
+        alphabet = None
+        if any(isinstance(e, CharClass) for e in glushkov.symbols):
+            alphabet = Alphabet(set(glushkov.symbols))
+        for p, symbol in enumerate(glushkov.symbols, 1):
+            labels.append((symbol,) if alphabet is None else tuple(alphabet.labelsOf(symbol)))
+            for label in labels[p]:
+                masks[label] = masks.get(label, 0) | 1 << p
+        follow = (glushkov.first,) + glushkov.follow
+        positionsOf, last = Automata.Index.positionsOf, glushkov.last
+        initial = self.newState(1, last, glushkov.nullable)
+        visited = {1: initial}
+        Dstates = deque((1,))
+        while Dstates:
+            bits = Dstates.pop()
+            state = visited[bits]
+            reached = 0
+            for p in positionsOf(bits):
+                reached |= follow[p]
+            for e in {label for q in positionsOf(reached) for label in labels[q]}:
+                u = reached & masks[e]
+                try:
+                    new_state = visited[u]
+                except KeyError:
+                    if self.__maxStates is not None and len(visited) >= self.__maxStates:
+                        raise StateBudgetException("DFA beyond %d states" % self.__maxStates)
+                    new_state = visited[u] = self.newState(u, last)
+                    Dstates.appendleft(u)
+                state.addTransition(e, new_state)
+        if self.__stats is not None:
+            self.__stats.states += len(visited)
+        return Automata(initial)
+
+    def newState ( self, bits, last, nullable = False ):
+        state = Automata.State()
+        state.accepting = bool(bits & last) or nullable
+        return state
+
+
+class AnchoredMatchingVisitor(object):
+    '''
+    Same matches, in the same order, as CompiledMatchingVisitor, found by
+    an engine running anchored, a ShiftAndAutomata or a PikeVm: the starts
+    of matches first, then every end of the match from each of them.
+    '''
+    def __init__ ( self, string, stats = None ):
+        self.__string = string
+        self.__stats = stats
+
+    def visit ( self, automata ):
+        string, started = self.__string, time.perf_counter()
+        spans = sorted((end, start) for start in automata.starts(string)
+                                    for end in automata.ends(string, start))
+        if self.__stats is not None:
+            self.__stats.times['match'] += time.perf_counter() - started
+        return [string[start:end] for end, start in spans]
+
+    def getString ( self ):
+        return self.__string
+    string = property(getString)
+
+
+class PikeVm(object):
+    '''
+    Simulates an NFA, Thompson/Pike VM style, instead of determinizing it.
+    Its states are numbered by Automata.Index, and the ones active at an
+    input position kept as a sparse set: a list of positions, deduplicated
+    by marking each with the step that added it. Building it takes time
+    linear in the epsilon closures of the NFA, and a run over n characters
+    at most O(n*m) time for m states, whatever the size of the DFA.
+    '''
+    def __init__ ( self, nfa ):
+        index = nfa.index().split()
+        positionsOf = Automata.Index.positionsOf
+        self.__nfa = nfa
+        self.__reverse = None
+        self.__labelOf = None if index.alphabet is None else index.labelOf
+        self.__closures = tuple(tuple(positionsOf(bits)) for bits in index.closures)
+        self.__moves = tuple({e: tuple(positionsOf(targets)) for e, targets in moves.items()}
+                             for moves in index.moves)
+        self.__accepting = bytearray(len(index.states))
+        for i in positionsOf(index.accepting): self.__accepting[i] = 1
+        self.__initial = self.__closures[index.positions[nfa.initial]]
+        self.__nullable = any(self.__accepting[i] for i in self.__initial)
+
+    def __len__ ( self ):
+        return len(self.__closures)
+
+    def getNullable ( self ): return self.__nullable
+    nullable = property(getNullable)
+
+    def getReverse ( self ):
+        '''
+        The PikeVm of the NFA with every transition reversed, started from
+        its accepting states and accepting in its initial one.
+        '''
+        if self.__reverse is None:
+            index = self.__nfa.index().split()
+            states = [Automata.State() for s in index.states]
+            initial = Automata.State()
+            for i, moves in enumerate(index.moves):
+                for event, targets in moves.items():
+                    for j in Automata.Index.positionsOf(targets):
+                        states[j].addTransition(event, states[i])
+                for j in Automata.Index.positionsOf(index.epsilons[i]):
+                    states[j].addTransition(Automata.EPSILON, states[i])
+            for i in Automata.Index.positionsOf(index.accepting):
+                initial.addTransition(Automata.EPSILON, states[i])
+            states[index.positions[self.__nfa.initial]].accepting = True
+            self.__reverse = PikeVm(Automata(initial))
+        return self.__reverse
+    reverse = property(getReverse)
+
+    def step ( self, active, event, marks, mark ):
+        '''
+        The states reached from active on event, and whether any accepts.
+        '''
+        closures, moves, accepting = self.__closures, self.__moves, self.__accepting
+        if self.__labelOf is not None: event = self.__labelOf(event)
+        following, accepts = [], False
+        for i in active:
+            for target in moves[i].get(event, ()):
+                for j in closures[target]:
+                    if marks[j] != mark:
+                        marks[j] = mark
+                        following.append(j)
+                        accepts = accepts or accepting[j]
+        return following, accepts
+
+    def starts ( self, string ):
+        '''
+        Every position where a match starts, ascending: the reversed NFA
+        is run backwards, unanchored, over the whole string.
+        '''
+        reverse, text = self.reverse, self.textOf(string)
+        initial, marks = list(reverse.__initial), [-1] * len(reverse)
+        starts, active = [], []
+        for i in range(len(text)-1, -1, -1):
+            active, accepts = reverse.step(active + initial, text[i], marks, i)
+            if accepts: starts.append(i)
+        starts.reverse()
+        return starts
+
+    def ends ( self, string, start ):
+        '''
+        Every end of a match starting at start, ascending.
+        '''
+        text, active, marks = self.textOf(string), self.__initial, [-1] * len(self)
+        for i in range(start, len(text)):
+            active, accepts = self.step(active, text[i], marks, i)
+            if not active: break
+            if accepts: yield i+1
+
+    def stepper ( self, chunk ):
+        '''
+        For Scanner: the events of chunk are its items, and configurations
+        are sets of states.
+        '''
+        closures, moves, accepting, labelOf = self.__closures, self.__moves, self.__accepting, self.__labelOf
+        def step ( active, c, taken ):
+            event = c if isinstance(c, str) else chr(c)
+            if labelOf is not None: event = labelOf(event)
+            following = set()
+            for i in active:
+                for target in moves[i].get(event, ()):
+                    following.update(closures[target])
+            return following - taken
+        return chunk, frozenset(self.__initial), frozenset(), step, lambda active: any(accepting[i] for i in active)
+
+    @staticmethod
+    def textOf ( string ):
+        return string if isinstance(string, str) else string.decode('latin-1')
+
+    def accept ( self, visitor ):
+        return visitor.visit(self)
+
+
+class CountingAutomata(object):
+    '''
+    Glushkov position automaton with counters, for counted repetitions
+    kept as they are rather than unrolled. Each move between positions
+    carries the counter operations of the repetitions it enters, loops in
+    or leaves: ENTER pushes a counter at 1, LOOP counts one more round
+    unless max is reached, saturating at min when there is no max, and
+    EXIT pops it unless fewer than min rounds were made. A configuration
+    is a position and the counters of the repetitions around it, and a run
+    keeps a set of them; its size stays proportional to the pattern text,
+    whatever the counts, and only the counter values seen are ever stored.
+    '''
+    ENTER, LOOP, EXIT = 0, 1, 2
+
+    def __init__ ( self, symbols, follow, last, nullable, reverse = None ):
+        self.__symbols = tuple(symbols)
+        self.__follow = tuple(tuple(moves) for moves in follow)   # follow[0]: from the start
+        self.__last = dict(last)
+        self.__nullable = nullable
+        self.__reverse = reverse
+        self.__masks = {}
+        for p, symbol in enumerate(self.__symbols, 1):
+            self.__masks[symbol] = self.__masks.get(symbol, 0) | 1 << p
+        self.__cache = {}
+
+    def __len__ ( self ):
+        return len(self.__symbols)
+
+    def getSymbols ( self ): return self.__symbols
+    symbols = property(getSymbols)
+
+    def getNullable ( self ): return self.__nullable
+    nullable = property(getNullable)
+
+    def getReverse ( self ): return self.__reverse
+    reverse = property(getReverse)
+
+    def maskOf ( self, c ):
+        '''
+        The positions matching character c, memoized.
+        '''
+        try:
+            return self.__cache[c]
+        except KeyError:
+            mask = self.__masks.get(c, 0)
+            for event, positions in self.__masks.items():
+                if isinstance(event, CharClass) and c in event: mask |= positions
+            self.__cache[c] = mask
+            return mask
+
+    @staticmethod
+    def apply ( counters, operations ):
+        '''
+        The counters after operations, or None if one of them fails.
+        '''
+        for kind, low, high in operations:
+            if kind == CountingAutomata.ENTER:
+                counters += (1,)
+            elif kind == CountingAutomata.LOOP:
+                value = counters[-1]
+                if high is None:
+                    counters = counters[:-1] + (min(value + 1, low),)
+                elif value < high:
+                    counters = counters[:-1] + (value + 1,)
+                else:
+                    return None
+            elif counters[-1] < low:
+                return None
+            else:
+                counters = counters[:-1]
+        return counters
+
+    def accepts ( self, configurations ):
+        apply, last = CountingAutomata.apply, self.__last
+        for p, counters in configurations:
+            for operations in last.get(p, ()):
+                if apply(counters, operations) is not None: return True
+        return False
+
+    def step ( self, configurations, c ):
+        '''
+        The configurations reached from configurations on character c.
+        '''
+        apply, follow, mask = CountingAutomata.apply, self.__follow, self.maskOf(c)
+        following = set()
+        if not mask: return following
+        for p, counters in configurations:
+            for q, operations in follow[p]:
+                if mask >> q & 1:
+                    result = apply(counters, operations)
+                    if result is not None: following.add((q, result))
+        return following
+
+    def stepper ( self, chunk ):
+        '''
+        For Scanner: the events of chunk are its items, and configurations
+        are sets of them.
+        '''
+        def step ( active, c, taken ):
+            return self.step(active, c if isinstance(c, str) else chr(c)) - taken
+        return chunk, frozenset([(0, ())]), frozenset(), step, self.accepts
+
+    def starts ( self, string ):
+        '''
+        Every position where a match starts, ascending: the automaton of
+        the reversed pattern is run backwards, unanchored, over the whole
+        string.
+        '''
+        reverse, text = self.__reverse, PikeVm.textOf(string)
+        starts, active = [], set()
+        for i in range(len(text)-1, -1, -1):
+            active.add((0, ()))
+            active = reverse.step(active, text[i])
+            if reverse.accepts(active): starts.append(i)
+        starts.reverse()
+        return starts
+
+    def ends ( self, string, start ):
+        '''
+        Every end of a match starting at start, ascending.
+        '''
+        text, active = PikeVm.textOf(string), {(0, ())}
+        for i in range(start, len(text)):
+            active = self.step(active, text[i])
+            if not active: break
+            if self.accepts(active): yield i+1
+
+    def accept ( self, visitor ):
+        return visitor.visit(self)
+
+
+class CountingVisitor(object):
+    '''
+    Builds the CountingAutomata of a syntax tree, and of its reverse, like
+    GlushkovVisitor but for the counter operations on the moves: first
+    and last positions come with the operations of entering and leaving
+    the repetitions around them, and a repetition links its last
+    positions to its first ones through a LOOP. A repetition of a
+    nullable operand can be left after any number of rounds.
+    '''
+    def visit ( self, tree ):
+        return self.build(tree, self.build(tree.reverse()))
+
+    def build ( self, tree, reverse = None ):
+        ENTER, LOOP, EXIT = CountingAutomata.ENTER, CountingAutomata.LOOP, CountingAutomata.EXIT
+        symbols, follow, info = [], [[]], {}
+        for node in tree.postorder():
+            if node.operator is None:
+                symbols.append(node.event)
+                follow.append([])
+                info[node] = (False, [(len(symbols), ())], [(len(symbols), ())])
+            elif node.operator == '\0':
+                (nullableA, firstA, lastA), (nullableB, firstB, lastB) = \
+                    info[node.children[0]], info[node.children[1]]
+                self.link(follow, lastA, firstB)
+                info[node] = (nullableA and nullableB,
+                              firstA + firstB if nullableA else firstA,
+                              lastA + lastB if nullableB else lastB)
+            elif node.operator == '|':
+                (nullableA, firstA, lastA), (nullableB, firstB, lastB) = \
+                    info[node.children[0]], info[node.children[1]]
+                info[node] = (nullableA or nullableB, firstA + firstB, lastA + lastB)
+            elif isinstance(node.operator, Repeat):
+                nullable, first, last = info[node.children[0]]
+                low = 0 if nullable else node.operator.min
+                self.link(follow, last, first, ((LOOP, low, node.operator.max),))
+                info[node] = (nullable or low == 0,
+                              [(q, ((ENTER, 0, None),) + ops) for q, ops in first],
+                              [(p, ops + ((EXIT, low, None),)) for p, ops in last])
+            else:
+                nullable, first, last = info[node.children[0]]
+                self.link(follow, last, first)
+                info[node] = (nullable or node.operator == '*', first, last)
+        nullable, first, last = info[tree]
+        follow[0] = first
+        ends = {}
+        for p, ops in last: ends.setdefault(p, []).append(ops)
+        return CountingAutomata(symbols, follow, ends, nullable, reverse)
+
+    def link ( self, follow, sources, targets, through = () ):
+        for p, left in sources:
+            follow[p].extend((q, left + through + right) for q, right in targets)
+
+
 class ThompsonVisitor(object):
+
+    def __init__ ( self, stats = None ):
+        self.__stats = stats
     
     def visit ( self, parser ):
-        self.eval(parser)
+        if self.__stats is None: return self.eval(parser)
+        with self.__stats.timer('thompson'):
+            self.eval(parser)
         
     def eval ( self, parser ):
         operator = parser.popOp()
@@ -297,6 +2838,7 @@ class ThompsonVisitor(object):
         elif operator == '+': self.plus(parser)
         elif operator == '|': self.union(parser)
         elif operator == '\0': self.concat(parser)
+        elif isinstance(operator, Repeat): self.repeat(parser, operator)
         else:
             raise UnknownOperatorException(operator)
     
@@ -308,7 +2850,7 @@ class ThompsonVisitor(object):
 
     def plus ( self, parser ):
         nfa = parser.pop()
-        afterState = Automata.State()
+        afterState = parser.newState()
         nfa[-1].addTransition(Automata.EPSILON, nfa[0])
         nfa[-1].addTransition(Automata.EPSILON, afterState)
         nfa.append(afterState)
@@ -316,7 +2858,7 @@ class ThompsonVisitor(object):
 
     def star ( self, parser ):
         nfa = parser.pop()
-        beforeState, afterState = Automata.State(), Automata.State()
+        beforeState, afterState = parser.newState(), parser.newState()
         beforeState.addTransition(Automata.EPSILON, afterState)
         beforeState.addTransition(Automata.EPSILON, nfa[0])
         nfa[-1].addTransition(Automata.EPSILON, afterState)
@@ -325,9 +2867,43 @@ class ThompsonVisitor(object):
         nfa.append(afterState)
         parser.push(nfa)
 
+    def repeat ( self, parser, operator ):
+        '''
+        Unrolls a counted repetition: max copies of the operand, those past
+        min with a way out to the end, or for no max, min copies the last
+        of which loops. The way out is from a state of its own before the
+        copy, as in star: the operand's first state may be looped back to.
+        '''
+        nfa = parser.pop()
+        count = max(operator.min, 1) if operator.max is None else operator.max
+        copies = [nfa] + [self.copy(parser, nfa) for i in range(count - 1)]
+        afterState = parser.newState()
+        result = []
+        for i, copy in enumerate(copies):
+            if i >= operator.min:
+                beforeState = parser.newState()
+                beforeState.addTransition(Automata.EPSILON, copy[0])
+                beforeState.addTransition(Automata.EPSILON, afterState)
+                copy = [beforeState] + copy
+            if result: result[-1].addTransition(Automata.EPSILON, copy[0])
+            result.extend(copy)
+        if operator.max is None:
+            copies[-1][-1].addTransition(Automata.EPSILON, copies[-1][0])
+        result[-1].addTransition(Automata.EPSILON, afterState)
+        result.append(afterState)
+        parser.push(result)
+
+    def copy ( self, parser, nfa ):
+        states = {s: parser.newState() for s in nfa}
+        for s in nfa:
+            for event, targets in s.next().items():
+                for t in targets:
+                    states[s].addTransition(event, states[t])
+        return [states[s] for s in nfa]
+
     def union ( self, parser ):
         nfaB, nfaA = parser.pop(), parser.pop()   # Pop order matters: AB != BA
-        beforeState, afterState = Automata.State(), Automata.State()
+        beforeState, afterState = parser.newState(), parser.newState()
         beforeState.addTransition(Automata.EPSILON, nfaA[0])
 
         beforeState.addTransition(Automata.EPSILON, nfaB[0])
@@ -339,3 +2915,300 @@ class ThompsonVisitor(object):
         parser.push(nfaA)
 
 
+class Pattern(object):
+    '''
+    A compiled pattern, matched by the first of the ENGINES that fits it
+    unless one is asked for: 'shiftand', the bit-parallel Glushkov
+    automaton, for patterns of at most ShiftAndAutomata.MAX_POSITIONS
+    positions; 'counting', a CountingAutomata, for longer patterns with
+    counted repetitions, which it keeps as counters where every other
+    engine unrolls them; 'dfa', the minimized DFA in table form built by
+    FollowposVisitor, if it has at most maxStates states; and 'nfa', a
+    PikeVm simulating the Thompson NFA. The DFA is only built when needed,
+    by the 'dfa' engine, batch matching or incremental matching, and
+    never beyond maxStates states. A pattern is never modified once built
+    but for its engines, built under a lock, so it can be shared by any
+    number of callers and threads.
+    '''
+    ENGINES = ('shiftand', 'counting', 'dfa', 'nfa')
+    MAX_STATES = 10000
+
+    def __init__ ( self, syntax, stats = None, engine = None, maxStates = MAX_STATES ):
+        self.__syntax = syntax
+        self.__stats = stats
+        self.__maxStates = maxStates
+        self.__dfa = self.__vm = self.__glushkov = self.__counting = None
+        self.__overBudget = False   # whether the DFA was found to need more than maxStates states
+        self.__lock = threading.RLock()
+        if stats is None:
+            tree = Parser().accept(TreeVisitor(), syntax)
+        else:
+            with stats.timer('parse'):
+                tree = Parser().accept(TreeVisitor(), syntax)
+        self.__tree = tree
+        self.__prefilter = tree.accept(LiteralVisitor())
+        if engine is None:
+            if tree.positions() <= ShiftAndAutomata.MAX_POSITIONS:
+                engine = 'shiftand'
+                self.getGlushkov()
+            elif tree.counted():
+                engine = 'counting'
+            else:
+                try:
+                    self.getDfa()
+                    engine = 'dfa'
+                except StateBudgetException:
+                    engine = 'nfa'
+        elif engine not in Pattern.ENGINES:
+            raise ValueError("Unknown engine: %r" % engine)
+        self.__engine = engine
+        if engine == 'dfa': self.getDfa()
+        elif engine == 'nfa': self.getVm()
+        elif engine == 'shiftand': self.getGlushkov()
+        elif engine == 'counting': self.getCounting()
+
+    def __repr__ ( self ):
+        return "Pattern(%r)" % self.__syntax
+
+    def getSyntax ( self ): return self.__syntax
+    syntax = property(getSyntax)
+
+    def getEngine ( self ): return self.__engine
+    engine = property(getEngine)
+
+    def getMaxStates ( self ): return self.__maxStates
+    maxStates = property(getMaxStates)
+
+    def thompson ( self ):
+        stats = self.__stats
+        if stats is None:
+            thompsonsm = Parser().accept(ThompsonVisitor(), self.__syntax)
+        else:
+            # the parser calls the ThompsonVisitor, keep its time out of 'parse'
+            thompson = stats.times['thompson']
+            with stats.timer('parse'):
+                thompsonsm = Parser().accept(ThompsonVisitor(stats), self.__syntax)
+            stats.times['parse'] -= stats.times['thompson'] - thompson
+        return Automata(thompsonsm[0])
+
+    def compileDfa ( self, maxStates = None ):
+        dfa = FollowposVisitor(self.__stats, maxStates).determinize(self.glushkov)
+        return dfa.accept(MinimizingVisitor(self.__stats)).accept(CompilingVisitor())
+
+    def getDfa ( self ):
+        '''
+        The compiled DFA, built on first use; raises StateBudgetException if
+        it would have more than maxStates states.
+        '''
+        if self.__dfa is None and not self.__overBudget:
+            with self.__lock:
+                if self.__dfa is None and not self.__overBudget:
+                    try:
+                        self.__dfa = self.compileDfa(self.__maxStates)
+                    except StateBudgetException:
+                        self.__overBudget = True
+        if self.__dfa is None:
+            raise StateBudgetException("DFA of %r beyond %d states" % (self.__syntax, self.__maxStates))
+        return self.__dfa
+    dfa = property(getDfa)
+
+    def getVm ( self ):
+        if self.__vm is None:
+            with self.__lock:
+                if self.__vm is None: self.__vm = PikeVm(self.thompson())
+        return self.__vm
+    vm = property(getVm)
+
+    def getGlushkov ( self ):
+        if self.__glushkov is None:
+            with self.__lock:
+                if self.__glushkov is None: self.__glushkov = self.__tree.accept(GlushkovVisitor())
+        return self.__glushkov
+    glushkov = property(getGlushkov)
+
+    def getCounting ( self ):
+        if self.__counting is None:
+            with self.__lock:
+                if self.__counting is None: self.__counting = self.__tree.accept(CountingVisitor())
+        return self.__counting
+    counting = property(getCounting)
+
+    def getPrefilter ( self ): return self.__prefilter
+    prefilter = property(getPrefilter)
+
+    def anchored ( self ):
+        '''
+        The engine running anchored, if the pattern isn't matched by its DFA.
+        '''
+        if self.__engine == 'shiftand': return self.__glushkov
+        if self.__engine == 'nfa': return self.__vm
+        if self.__engine == 'counting': return self.__counting
+        return None
+
+    def fittingDfa ( self ):
+        '''
+        The DFA if it fits in maxStates states, for the matching that is
+        fastest on its table whatever the engine; None if it doesn't, or
+        for the counting engine, whose point is not to unroll the pattern.
+        '''
+        if self.__engine == 'counting': return None
+        try:
+            return self.getDfa()
+        except StateBudgetException:
+            return None
+
+    def findall ( self, string, stats = None ):
+        if self.__prefilter.rejects(string): return []
+        dfa = self.fittingDfa()
+        if dfa is not None:
+            return dfa.accept(CompiledMatchingVisitor(string, stats))
+        return self.anchored().accept(AnchoredMatchingVisitor(string, stats))
+
+    def finditer ( self, string ):
+        if self.__prefilter.rejects(string): return iter(())
+        engine = self.anchored()
+        if engine is not None:
+            candidates = self.__prefilter.candidates(string) if self.__prefilter.prefixes else None
+            return engine.accept(SearchingVisitor(string, candidates))
+        if self.__prefilter.prefixes:
+            return self.__dfa.accept(PrefilteredSearchingVisitor(string, self.__prefilter))
+        return self.__dfa.accept(SearchingVisitor(string))
+
+    def matchMany ( self, strings ):
+        return self.batch(strings, False)
+
+    def fullmatchMany ( self, strings ):
+        return self.batch(strings, True)
+
+    def batch ( self, strings, full ):
+        '''
+        BatchMatchingVisitor on the fittingDfa if any; otherwise the strings
+        are matched one by one with the engine, into a result of the same
+        type.
+        '''
+        dfa = self.fittingDfa()
+        if dfa is not None:
+            return dfa.accept(BatchMatchingVisitor(strings, full))
+        engine = self.anchored()
+        if full:
+            result = [len(s) in engine.ends(s, 0) if s else engine.nullable for s in strings]
+        else:
+            empty = 0 if engine.nullable else -1
+            result = [max(engine.ends(s, 0), default=empty) for s in strings]
+        if numpy is None: return result
+        return numpy.array(result, dtype=bool if full else numpy.int64)
+
+    def matcher ( self, text, interval = 1024 ):
+        '''
+        An IncrementalMatcher of text, which needs the DFA: raises
+        StateBudgetException if it would have more than maxStates states.
+        '''
+        return IncrementalMatcher(self.dfa, text, interval)
+
+    def searchMany ( self, documents, workers = None, executor = None ):
+        '''
+        The spans of finditer in each of many documents, searched at once
+        by a pool of workers threads, or by executor if given, all sharing
+        this pattern as is: matching keeps its state in each call. Threads
+        only run Python code in parallel on free-threaded builds.
+        '''
+        search = lambda document: list(self.finditer(document))
+        if executor is not None:
+            return list(executor.map(search, documents))
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(search, documents))
+
+
+class PatternSet(object):
+    '''
+    Many patterns compiled into a single DFA: their Thompson NFAs are
+    joined under a new initial state and determinized together, and each
+    accepting state carries the set of ids, i.e. positions in syntaxes, of
+    the patterns it accepts.
+    '''
+    def __init__ ( self, syntaxes ):
+        self.__syntaxes = tuple(syntaxes)
+        initial = Automata.State()
+        for pid, syntax in enumerate(self.__syntaxes):
+            thompsonsm = Parser().accept(ThompsonVisitor(), syntax)
+            thompsonsm[-1].accepting = frozenset((pid,))
+            initial.addTransition(Automata.EPSILON, thompsonsm[0])
+        dfa = Automata(initial).accept(NfaToDfaVisitor()).accept(MinimizingVisitor())
+        self.__dfa = dfa.accept(CompilingVisitor())
+
+    def __len__ ( self ):
+        return len(self.__syntaxes)
+
+    def getSyntaxes ( self ): return self.__syntaxes
+    syntaxes = property(getSyntaxes)
+
+    def getDfa ( self ): return self.__dfa
+    dfa = property(getDfa)
+
+    def scan ( self, string, workers = 1 ):
+        if workers > 1:
+            return self.__dfa.accept(ParallelMatchingVisitor(string, workers))
+        return self.__dfa.accept(SetMatchingVisitor(string))
+
+    def matching ( self, string ):
+        return {pid for pid, start, end in self.scan(string)}
+
+
+class PatternCache(object):
+    '''
+    Least-recently-used cache of compiled patterns keyed on their syntax,
+    safe to use from many threads. Patterns are compiled outside of the
+    lock, so that threads compiling don't wait on each other.
+    '''
+    def __init__ ( self, maxSize = 512 ):
+        self.__maxSize = maxSize
+        self.__patterns = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = self.__misses = self.__evictions = 0
+
+    def __len__ ( self ):
+        return len(self.__patterns)
+
+    def __contains__ ( self, syntax ):
+        return syntax in self.__patterns
+
+    def getMaxSize ( self ): return self.__maxSize
+    maxSize = property(getMaxSize)
+
+    def getHits ( self ): return self.__hits
+    hits = property(getHits)
+
+    def getMisses ( self ): return self.__misses
+    misses = property(getMisses)
+
+    def getEvictions ( self ): return self.__evictions
+    evictions = property(getEvictions)
+
+    def get ( self, syntax ):
+        with self.__lock:
+            try:
+                pattern = self.__patterns[syntax]
+                self.__patterns.move_to_end(syntax)
+                self.__hits += 1
+                return pattern
+            except KeyError:
+                self.__misses += 1
+        pattern = Pattern(syntax)
+        with self.__lock:
+            pattern = self.__patterns.setdefault(syntax, pattern)   # another thread may have won
+            self.__patterns.move_to_end(syntax)
+            while len(self.__patterns) > self.__maxSize:
+                self.__patterns.popitem(last=False)
+                self.__evictions += 1
+        return pattern
+
+    def clear ( self ):
+        with self.__lock:
+            self.__patterns.clear()
+            self.__hits = self.__misses = self.__evictions = 0
+
+
+patternCache = PatternCache()
+
+def compile ( syntax ):
+    return patternCache.get(syntax)
@@ -1,13 +1,29 @@
+import io
+import os
+import random
+import struct
+import sys
+import tempfile
 import unittest
-from Parser import Automata, Parser, ThompsonVisitor, NfaToDfaVisitor, ReducingVisitor, MatchingVisitor
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from Benchmark import Benchmark
+from Parser import NotAStateException, IncrementalMatcher, PatternSyntaxException, CharClass, \
+    Alphabet, SerializationException, StateBudgetException, PikeVm, Repeat, CountingVisitor, \
+    Stats, Tracer, Automata, CompactAutomata, Parser, ThompsonVisitor, NfaToDfaVisitor, \
+    ReducingVisitor, MatchingVisitor, MinimizingVisitor, CompiledDfa, CompilingVisitor, \
+    SerializingVisitor, CompiledMatchingVisitor, LazyDfa, LazyMatchingVisitor, SearchingVisitor, \
+    StreamingVisitor, TreeVisitor, LiteralVisitor, PrefilteredSearchingVisitor, GlushkovVisitor, \
+    FollowposVisitor, ShiftAndAutomata, AnchoredMatchingVisitor, SetMatchingVisitor, \
+    ParallelMatchingVisitor, Pattern, PatternSet, PatternCache, compile
 
 class AutomataTest(unittest.TestCase):
 
     def testState ( self ):
         states = [Automata.State() for i in range(10)]
         self.assertEqual(\
-            range(states[0].id, states[-1].id+1), map(lambda s: s.id, states),
-            "Created %d states with ids %s" % (len(states), str(map(lambda s: s.id, states))))
+            list(range(states[0].id, states[-1].id+1)), list(map(lambda s: s.id, states)),
+            "Created %d states with ids %s" % (len(states), str(list(map(lambda s: s.id, states)))))
  
         s1, s2, s3 = states[0:3]
         s1.addTransition(Automata.EPSILON, s2)
@@ -67,6 +83,82 @@ class AutomataTest(unittest.TestCase):
         self.assertNotIn(s1, c, "s1 in 'a' closure of (s1, s4)")
         self.assertNotIn(s4, c, "s4 in 'a' closure of (s1, s4)")
         
+    def testIndex ( self ):
+        s1, s2, s3, s4, s5 = [Automata.State() for i in range(5)]
+        s1.addTransition(Automata.EPSILON, s2)
+        s2.addTransition(Automata.EPSILON, s3)
+        s3.addTransition(Automata.EPSILON, s1)
+        s3.addTransition('a', s4)
+        s4.addTransition(Automata.EPSILON, s5)
+        s5.accepting = True
+        nfa = Automata(s1)
+        index = nfa.index()
+        self.assertIs(index, nfa.index(), "Index rebuilt without changes")
+        for s in (s1, s2, s3):
+            c = index.statesOf(index.closure(index.bits((s,))))
+            self.assertEqual(c, {s1, s2, s3}, "Epsilon closure of %s: %s" % (str(s.id), str(c)))
+        bits = index.move(index.bits((s1, s2, s3)), 'a')
+        self.assertEqual(index.statesOf(bits), {s4}, "'a' move of (s1, s2, s3)")
+        self.assertTrue(index.closure(bits) & index.accepting, "s5 not in closure of s4")
+        self.assertEqual(index.events(index.bits((s1, s3))), {'a'}, "Events of (s1, s3)")
+        self.assertRaises(NotAStateException, index.bits, (Automata.State(),))
+        s5.addTransition(Automata.EPSILON, s1)
+        self.assertIsNot(index, nfa.index(), "Index not rebuilt after a change")
+        self.assertIn(s3, nfa.closure((s4,), Automata.EPSILON), "s3 not in Epsilon closure of (s4,)")
+        index = nfa.index()
+        Automata.State().addTransition('a', Automata.State())
+        self.assertIs(index, nfa.index(), "Index rebuilt after a change to states of no automata")
+        Automata(s4).index()
+        s4.accepting = False
+        self.assertIsNot(index, nfa.index(), "Index not rebuilt after a change to a state in two automata")
+        s1, s2 = Automata.State(), Automata.State()
+        s1.addTransition('a', s2)
+        a1, a2 = Automata(s1), Automata(s1)     # equal sets, distinct automata
+        a1.index(), a2.index()
+        s2.addTransition(Automata.EPSILON, s1)
+        self.assertIn(s1, a2.closure((s2,), Automata.EPSILON), "Index of an equal automata not rebuilt")
+        s3 = Automata.State()
+        s2.addTransition(Automata.EPSILON, s3)
+        self.assertIn(s3, a1.closure((s2,), Automata.EPSILON), "State linked to after the automata was built")
+        self.assertEqual(len(a1.accept(NfaToDfaVisitor())), 2, "DFA of an automata grown since")
+
+    def testCompactAutomata ( self ):
+        store = CompactAutomata()
+        s1, s2, s3 = store.newState(), store.newState(), store.newState()
+        s1.addTransition(Automata.EPSILON, s2)
+        s1.addTransition('b', s3)
+        s2.addTransition('a', s1)
+        s2.addTransition('a', s3)
+        self.assertEqual(store.initial, s1, "s1 is not the initial state")
+        self.assertEqual([s.id for s in (s1, s2, s3)], [0, 1, 2], "State ids")
+        self.assertEqual(s1.next(), {Automata.EPSILON: (s2,), 'b': (s3,)}, "s1 transitions: " + str(s1.next()))
+        self.assertEqual(s2.next('a'), (s1, s3), "s2 transitions: " + str(s2.next()))
+        self.assertIn(s3, store.closure((s1,), 'b'), "s3 not in 'b' closure of (s1,)")
+        self.assertEqual(store.closure((s1,), Automata.EPSILON), {s1, s2}, "Epsilon closure of (s1,)")
+        self.assertRaises(NotAStateException, store.closure, (CompactAutomata().newState(),), 'a')
+        s2.removeTransition(s1)
+        self.assertEqual(s2.next('a'), (s3,), "s1 still in s2.next('a')")
+
+        store = CompactAutomata()
+        thompsonsm = Parser(factory=store.newState).accept(ThompsonVisitor(), "(a|b)*abb")
+        store.initial = thompsonsm[0]
+        dfa = store.accept(NfaToDfaVisitor())
+        self.assertIsInstance(dfa, CompactAutomata)
+        self.assertEqual(len(dfa), 5, "Subset construction built %d states" % len(dfa))
+        self.assertEqual(len(dfa.accept(MinimizingVisitor())), 4, "Minimal DFA is not 4 states")
+        store = CompactAutomata()
+        store.initial = Parser(factory=store.newState).accept(ThompsonVisitor(), "[a-c]x|.y")[0]
+        matches = store.accept(NfaToDfaVisitor()).accept(MatchingVisitor("bxzyax"))
+        self.assertEqual(matches, ["bx", "zy", "ax"], "Matches of classes: " + str(matches))
+
+    def testDeepAutomata ( self ):
+        states = [Automata.State() for i in range(5000)]
+        for s1, s2 in zip(states, states[1:]):
+            s1.addTransition(Automata.EPSILON, s2)
+        nfa = Automata(states[0])
+        self.assertEqual(len(nfa), 5000, "Deep NFA has %d states" % len(nfa))
+        self.assertEqual(len(nfa.closure((states[0],), Automata.EPSILON)), 5000, "Deep epsilon closure")
+
     def testNfaToDfaVisitor ( self ):
         s1, s2, s3, s4, s5 = [Automata.State() for i in range(5)]
         s1.addTransition(Automata.EPSILON, s2)
@@ -128,6 +220,46 @@ class AutomataTest(unittest.TestCase):
         self.assertNotIn(s3, s6.fringe(), "s3 still in s6 fringe")
         self.assertNotIn(s3, s7.fringe(), "s3 still in s7 fringe")
 
+    def testMinimizingVisitor ( self ):
+        nfa = Automata(Parser().accept(ThompsonVisitor(), "(a|b)*abb")[0])
+        dfa = nfa.accept(NfaToDfaVisitor()).accept(MinimizingVisitor())
+        self.assertEqual(len(dfa), 4, "Minimal DFA has %d states: %s" % (len(dfa), str(dfa)))
+        s0 = dfa.initial
+        s1 = s0.next('a')[0]
+        s2 = s1.next('b')[0]
+        s3 = s2.next('b')[0]
+        self.assertEqual(s0.next('b')[0], s0, "initial-(b)-> doesn't point to itself")
+        self.assertEqual(s1.next('a')[0], s1, "initial-(a)->()-(a)-> doesn't point to itself")
+        self.assertEqual(s2.next('a')[0], s1, "initial-(a)->()-(b)->()-(a)-> is not initial-(a)->()")
+        self.assertEqual(s3.next('a')[0], s1, "initial-(a)->()-(b)->()-(b)->()-(a)-> is not initial-(a)->()")
+        self.assertEqual(s3.next('b')[0], s0, "initial-(a)->()-(b)->()-(b)->()-(b)-> is not initial")
+        self.assertEqual([s.accepting for s in (s0, s1, s2, s3)], [False, False, False, True])
+
+        s1, s2, s3 = [Automata.State() for i in range(3)]
+        s1.addTransition('a', s2)
+        s2.addTransition('b', s3)
+        s3.addTransition(('a', 'b'), s3)
+        dfa = Automata(s1).accept(MinimizingVisitor())
+        self.assertEqual(len(dfa), 1, "Empty language DFA has %d states" % len(dfa))
+        self.assertEqual(dfa.initial.next(), {}, "Empty language DFA has transitions")
+
+    def testCompilingVisitor ( self ):
+        s1, s2, s3 = [Automata.State() for i in range(3)]
+        s1.addTransition(('a', 'b'), s2)
+        s2.addTransition('c', s3)
+        s3.addTransition(('a', 'b'), s3)
+        s3.accepting = True
+        cdfa = Automata(s1).accept(CompilingVisitor())
+        self.assertEqual(len(cdfa), 3, "Compiled DFA has %d states" % len(cdfa))
+        self.assertEqual(cdfa.nclasses, 3, "Classes: " + str(cdfa.classes))
+        self.assertEqual(cdfa.classOf('a'), cdfa.classOf('b'), "'a' and 'b' not in the same class")
+        self.assertEqual(cdfa.classOf('z'), 0, "'z' not in the default class")
+        self.assertEqual(cdfa.next(0, 'a'), 1, "0-(a)-> is not 1")
+        self.assertEqual(cdfa.next(0, 'c'), CompiledDfa.DEAD, "0-(c)-> is not dead")
+        self.assertEqual(cdfa.next(1, 'c'), 2, "1-(c)-> is not 2")
+        self.assertEqual(cdfa.next(2, 'b'), 2, "2-(b)-> is not 2")
+        self.assertEqual(list(cdfa.accepting), [0, 0, 1], "Accepting: " + str(list(cdfa.accepting)))
+
 
 class ParserTest(unittest.TestCase):
 
@@ -217,7 +349,404 @@ class ParserTest(unittest.TestCase):
         self.assertEqual(\
             matches, ["Emil", "Emily", "Emil"],\
             "Matcher couldn't find all matches: " + str(matcher.matches))
-        
+
+    def testTracedMatch ( self ):
+        class RecordingTracer(Tracer):
+            def __init__ ( self ):
+                self.events = []
+            def transition ( self, event, position, state ):
+                self.events.append((event, position))
+            def match ( self, match, beg, end ):
+                self.events.append((match, beg, end))
+
+        stats, tracer = Stats(), RecordingTracer()
+        pattern = Pattern("Emily*", stats, "dfa")
+        self.assertTrue(stats.states > 0, "No DFA states counted")
+        self.assertTrue(all(t >= 0 for t in stats.times.values()), "Times: " + str(stats.times))
+        nfa = Automata(Parser().accept(ThompsonVisitor(), "Emily*")[0])
+        dfa = nfa.accept(NfaToDfaVisitor()).accept(ReducingVisitor())
+        closures = Stats()
+        nfa.accept(NfaToDfaVisitor(closures))
+        self.assertTrue(closures.closures > closures.states, "Closures counted: %d" % closures.closures)
+        matches = dfa.accept(MatchingVisitor("Emil Emily", tracer, stats))
+        self.assertEqual(matches, ["Emil", "Emil", "Emily"], "Matches: " + str(matches))
+        self.assertEqual(tracer.events, \
+            [('E', 0), ('m', 1), ('i', 2), ('l', 3), ("Emil", 0, 4), \
+             ('E', 5), ('m', 6), ('i', 7), ('l', 8), ("Emil", 5, 9), ('y', 9), ("Emily", 5, 10)], \
+            "Traced events: " + str(tracer.events))
+        self.assertEqual((stats.transitions, stats.matchers), (9, 2), "Stats: " + str(stats))
+        pattern.findall("Emil Emily", stats)
+        self.assertEqual((stats.transitions, stats.matchers), (18, 4), "Stats: " + str(stats))
+
+    def testCompiledMatch ( self ):
+        parser = Parser()
+        syntax = "Emily*"
+        thompsonsm = parser.accept(ThompsonVisitor(), syntax)
+        dfa = Automata(thompsonsm[0]).accept(NfaToDfaVisitor())
+        cdfa = dfa.accept(ReducingVisitor()).accept(CompilingVisitor())
+        matcher = CompiledMatchingVisitor("Emily went visiting his uncle Emil")
+        matches = cdfa.accept(matcher)
+        self.assertEqual(\
+            matches, ["Emil", "Emily", "Emil"],\
+            "Matcher couldn't find all matches: " + str(matcher.matches))
+
+    def testLazyMatch ( self ):
+        parser = Parser()
+        nfa = Automata(parser.accept(ThompsonVisitor(), "Emily*")[0])
+        ldfa = LazyDfa(nfa)
+        matches = ldfa.accept(LazyMatchingVisitor("Emily went visiting his uncle Emil"))
+        self.assertEqual(\
+            matches, ["Emil", "Emily", "Emil"],\
+            "Matcher couldn't find all matches: " + str(matches))
+
+        syntax = "(a|b)*a(a|b)(a|b)(a|b)(a|b)"
+        nfa = Automata(parser.accept(ThompsonVisitor(), syntax)[0])
+        string = "abbabaaabbbababbbaabaaabbbbabaabba" * 4
+        unbounded, bounded = LazyDfa(nfa), LazyDfa(nfa, 4)
+        expected = unbounded.accept(LazyMatchingVisitor(string))
+        matches = bounded.accept(LazyMatchingVisitor(string))
+        self.assertEqual(matches, expected, "Bounded cache changed the matches")
+        self.assertTrue(bounded.flushes > 0, "Bounded cache never flushed")
+        self.assertTrue(len(bounded) <= 4, "Bounded cache holds %d states" % len(bounded))
+
+    def testCompile ( self ):
+        pattern = compile("Emily*")
+        self.assertIsInstance(pattern, Pattern)
+        self.assertIs(pattern, compile("Emily*"), "Compiled pattern not cached")
+        self.assertEqual(\
+            pattern.findall("Emily went visiting his uncle Emil"), ["Emil", "Emily", "Emil"],\
+            "Compiled pattern couldn't find all matches")
+
+        cache = PatternCache(2)
+        a, b = cache.get("a"), cache.get("b")
+        self.assertIs(cache.get("a"), a, "'a' not cached")
+        c = cache.get("c")
+        self.assertNotIn("b", cache, "Least recently used pattern not evicted")
+        self.assertIn("a", cache, "Recently used pattern evicted")
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 3, 1),\
+            "Cache stats: %d hits, %d misses, %d evictions" % (cache.hits, cache.misses, cache.evictions))
+
+    def testSearch ( self ):
+        spans = list(compile("Emily*").finditer("Emily went visiting his uncle Emil"))
+        self.assertEqual(spans, [(0, 5), (30, 34)], "Spans: " + str(spans))
+        spans = list(compile("abcd|c").finditer("abcdcabc"))
+        self.assertEqual(spans, [(0, 4), (4, 5), (7, 8)], "Leftmost match not preferred: " + str(spans))
+        spans = list(compile("a|a+b").finditer("aaaab"))
+        self.assertEqual(spans, [(0, 5)], "Longest match not preferred: " + str(spans))
+        spans = list(compile("a|a+b").finditer("aaaa"))
+        self.assertEqual(spans, [(0, 1), (1, 2), (2, 3), (3, 4)], "Spans: " + str(spans))
+        spans = list(compile("(ab|ba)+").finditer("abababa"))
+        self.assertEqual(spans, [(0, 6)], "Matches overlap: " + str(spans))
+
+    def testStream ( self ):
+        cdfa = compile("(ab|ba)+").dfa
+        string = "xabababx abbab ba"
+        expected = list(cdfa.accept(SearchingVisitor(string)))
+        self.assertEqual(expected, [(1, 7), (9, 13), (15, 17)], "Spans: " + str(expected))
+        chunks = [string[i:i+3] for i in range(0, len(string), 3)]
+        spans = list(cdfa.accept(StreamingVisitor(chunks)))
+        self.assertEqual(spans, expected, "Spans over str chunks: " + str(spans))
+        spans = list(cdfa.accept(StreamingVisitor(io.BytesIO(string.encode()), 2)))
+        self.assertEqual(spans, expected, "Spans over a binary file: " + str(spans))
+        spans = list(cdfa.accept(StreamingVisitor(string.encode(), 1)))
+        self.assertEqual(spans, expected, "Spans over a buffer: " + str(spans))
+        pattern = Pattern("(ab|ba)+", engine="shiftand")
+        for automata in (pattern.glushkov, pattern.vm, pattern.counting):
+            spans = list(automata.accept(StreamingVisitor(chunks)))
+            self.assertEqual(spans, expected, "Spans of %s over str chunks: %s" % (type(automata).__name__, spans))
+
+    def testPatternSet ( self ):
+        patterns = PatternSet(["Emily*", "uncle", "(a|b)*abb", "le"])
+        matches = list(patterns.scan("Emily went visiting his uncle Emil, abba abb"))
+        self.assertEqual(matches, \
+            [(0, 0, 4), (0, 0, 5), (1, 24, 29), (3, 27, 29), (0, 30, 34), (2, 36, 39), (2, 41, 44)], \
+            "Pattern set matches: " + str(matches))
+        self.assertEqual(patterns.matching("my uncle Emil"), {0, 1, 3}, "Patterns matching")
+        self.assertEqual(patterns.matching("nothing"), set(), "Patterns matching")
+        payloads = PatternSet(["ab", "a(b|c)"]).dfa.payloads
+        self.assertIn(frozenset((0, 1)), payloads, "No state accepting both 'ab' and 'a(b|c)'")
+        self.assertIn(frozenset((1,)), payloads, "No state accepting only 'a(b|c)'")
+
+    def testSerialize ( self ):
+        string = "Emily went visiting his uncle Emil, abba abb"
+        cdfa = compile("Emily*").dfa
+        data = cdfa.accept(SerializingVisitor())
+        loaded = CompiledDfa.load(data)
+        self.assertEqual((len(loaded), loaded.nclasses), (len(cdfa), cdfa.nclasses), "Loaded DFA size")
+        self.assertEqual(list(loaded.table), list(cdfa.table), "Loaded transition table")
+        self.assertEqual(loaded.accept(CompiledMatchingVisitor(string)), ["Emil", "Emily", "Emil"],\
+            "Loaded DFA couldn't find all matches")
+
+        patterns = PatternSet(["Emily*", "uncle", "(a|b)*abb", "le"])
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                patterns.dfa.accept(SerializingVisitor(f))
+            loaded = CompiledDfa.open(path)
+            self.assertEqual(loaded.payloads, patterns.dfa.payloads, "Loaded pattern ids")
+            self.assertEqual(list(loaded.accept(SetMatchingVisitor(string))), list(patterns.scan(string)),\
+                "Loaded pattern set matches")
+            del loaded
+        finally:
+            os.remove(path)
+
+        self.assertRaises(SerializationException, CompiledDfa.load, b"RXDG" + data[4:])
+        self.assertRaises(SerializationException, CompiledDfa.load, data[:4] + struct.pack('<H', 1) + data[6:])
+        self.assertRaises(SerializationException, CompiledDfa.load, data[:-8])
+        self.assertRaises(SerializationException, CompiledDfa.load, data[:8])
+
+    def testParallelMatch ( self ):
+        patterns = PatternSet(["Emily*", "uncle", "(a|b)*abb", "le"])
+        string = "Emily went visiting his uncle Emil, abba abb. Emily bab, ababb ulle" * 3
+        expected = list(patterns.scan(string))
+        with ThreadPoolExecutor(4) as executor:
+            for size in (1, 5, 64):
+                matches = list(patterns.dfa.accept(ParallelMatchingVisitor(string, 8, executor, size)))
+                self.assertEqual(matches, expected, "Segments of %d: %s" % (size, str(matches)))
+            cdfa = compile("a|a+b").dfa
+            matches = list(cdfa.accept(ParallelMatchingVisitor("aaaabaab", 4, executor, 2)))
+            self.assertEqual(matches, list(cdfa.accept(SetMatchingVisitor("aaaabaab"))), "Pattern matches")
+        matches = list(patterns.dfa.accept(ParallelMatchingVisitor(string, 2, minSegment=16)))
+        self.assertEqual(matches, expected, "Process pool matches: " + str(matches))
+
+    def testBatchMatch ( self ):
+        pattern = Pattern("ab(c|d)+e*", engine="dfa")
+        strings = ["abc", "abdce", "ab", "", "abcx", "xabc", "abcdeee", "abe"]
+        for numpy in (sys.modules['Parser'].numpy, None):   # with NumPy if available, and without
+            with mock.patch('Parser.numpy', numpy):
+                ends = pattern.matchMany(strings)
+                self.assertEqual(list(ends), [3, 5, -1, -1, 3, -1, 7, -1], "Match ends: " + str(ends))
+                full = pattern.fullmatchMany(strings)
+                self.assertEqual(list(full), [True, True, False, False, False, False, True, False],\
+                    "Full matches: " + str(full))
+                ends = pattern.matchMany([s.encode() for s in strings])
+                self.assertEqual(list(ends), [3, 5, -1, -1, 3, -1, 7, -1], "Match ends of bytes: " + str(ends))
+                self.assertEqual(list(pattern.matchMany([])), [], "Matches of no strings")
+                others = ((compile("ab(c|d)+e*"), [3, 5, -1, -1, 3, -1, 7, -1]),
+                          (Pattern("(a|b)*a" + "(a|b)" * 12 + "(c|d)", maxStates=100), [-1] * 8))
+                for other, expected in others:
+                    ends = other.matchMany(strings)
+                    self.assertEqual((type(ends), list(ends)), (type(pattern.matchMany(strings)), expected),\
+                        "Match ends with %s: %s" % (other.engine, ends))
+                    self.assertEqual(type(other.fullmatchMany(strings)), type(pattern.fullmatchMany(strings)),\
+                        "Type of the %s full result" % other.engine)
+
+    def testPrefilter ( self ):
+        tree = Parser().accept(TreeVisitor(), "ab(c|d)+e*")
+        prefilter = tree.accept(LiteralVisitor())
+        self.assertEqual(prefilter.prefixes, {"abc", "abd"}, "Prefixes: " + str(prefilter))
+        prefilter = compile("(a|b)*abb").prefilter
+        self.assertEqual((prefilter.prefixes, prefilter.factors), (None, {"abb"}), "Literals: " + str(prefilter))
+        self.assertTrue(prefilter.rejects("abababa"), "String without the factor not rejected")
+        pattern = compile("Emily*")
+        string = "Emily went visiting his uncle Emil, Emilyyy"
+        spans = list(pattern.dfa.accept(PrefilteredSearchingVisitor(string, pattern.prefilter)))
+        self.assertEqual(spans, list(pattern.dfa.accept(SearchingVisitor(string))), "Spans: " + str(spans))
+        spans = list(pattern.finditer(string.encode()))
+        self.assertEqual(spans, [(0, 5), (30, 34), (36, 43)], "Spans of bytes: " + str(spans))
+        self.assertEqual(compile("(a|b)*abb").findall("ababa"), [], "Matches of a rejected string")
+        pattern = Pattern("ab|a[^x]*y", engine="dfa")    # dense candidates, with matchers alive to the end
+        spans = list(pattern.finditer("ab" * 20000))
+        self.assertEqual(spans, [(i, i+2) for i in range(0, 40000, 2)], "Spans of dense candidates: " + str(spans[:3]))
+        for engine in Pattern.ENGINES:
+            pattern = Pattern("\u03a9mega|mega", engine=engine)
+            spans, matches = list(pattern.finditer(b"omega mega")), pattern.findall(b"omega")
+            self.assertEqual((spans, matches), ([(1, 5), (6, 10)], [b"mega"]), "Bytes with %s: %s" % (engine, spans))
+
+    def testShiftAnd ( self ):
+        automata = Parser().accept(TreeVisitor(), "a(b|c)*d").accept(GlushkovVisitor())
+        self.assertEqual((automata.symbols, automata.first, automata.last), (('a', 'b', 'c', 'd'), 0b10, 0b10000),\
+            "Positions: %r, first %s, last %s" % (automata.symbols, bin(automata.first), bin(automata.last)))
+        self.assertEqual(automata.follow, (0b11100, 0b11100, 0b11100, 0), "Follow: " + str(automata.follow))
+        self.assertEqual(automata.starts("xabdacd"), [1, 4], "Starts: " + str(automata.starts("xabdacd")))
+        self.assertEqual(list(automata.ends("abdbd", 0)), [3], "Ends: " + str(list(automata.ends("abdbd", 0))))
+        pattern = compile("(a|b)*abb")
+        self.assertEqual(pattern.engine, "shiftand", "Engine of a short pattern: " + pattern.engine)
+        string = "abbabababbxabb"
+        matches = pattern.glushkov.accept(AnchoredMatchingVisitor(string))
+        self.assertEqual(matches, pattern.dfa.accept(CompiledMatchingVisitor(string)), "Matches: " + str(matches))
+        self.assertEqual(pattern.findall(string), matches, "Matches on the DFA")
+        spans = list(pattern.finditer(string.encode()))
+        self.assertEqual(spans, [(0, 10), (11, 14)], "Spans: " + str(spans))
+        for engine in ("shiftand", "nfa", "counting"):     # in linear time: matchers alive to the end are merged
+            pattern = Pattern("ab|a[^x]*y", engine=engine)
+            spans = list(pattern.finditer("ab" * 20000))
+            self.assertEqual(spans, [(i, i+2) for i in range(0, 40000, 2)], "Spans with %s: %s" % (engine, spans[:3]))
+            spans = list(pattern.finditer("abxab" * 3 + "ay"))
+            self.assertEqual(spans, [(0, 2), (3, 5), (5, 7), (8, 10), (10, 12), (13, 17)], "Spans with %s: %s" % (engine, spans))
+        pattern = Pattern("(a|b)*" + "a" * ShiftAndAutomata.MAX_POSITIONS)
+        self.assertEqual(pattern.engine, "dfa", "Engine of a long pattern: " + pattern.engine)
+        self.assertRaises(ValueError, Pattern, "ab", None, "backtracking")
+
+    def testPikeVm ( self ):
+        nfa = Automata(Parser().accept(ThompsonVisitor(), "a(b|c)*d")[0])
+        vm = PikeVm(nfa)
+        self.assertEqual(vm.starts("xabdacd"), [1, 4], "Starts: " + str(vm.starts("xabdacd")))
+        self.assertEqual(list(vm.ends(b"abcbdd", 0)), [5], "Ends: " + str(list(vm.ends(b"abcbdd", 0))))
+        self.assertFalse(vm.nullable, "Nullable NFA")
+        syntax = "(a|b)*a" + "(a|b)" * 12
+        nfa = Automata(Parser().accept(ThompsonVisitor(), syntax)[0])
+        self.assertRaises(StateBudgetException, nfa.accept, NfaToDfaVisitor(None, 100))
+        pattern = Pattern(syntax + "(a|b)" * 60, maxStates=100)
+        self.assertEqual(pattern.engine, "nfa", "Engine of a pattern beyond the budget: " + pattern.engine)
+        string = "b" * 10 + "a" * 90
+        spans = list(pattern.finditer(string))
+        self.assertEqual(spans, [(0, 100)], "Spans: " + str(spans))
+        store = CompactAutomata()
+        store.initial = Parser(factory=store.newState).accept(ThompsonVisitor(), "a(b|c)*d")[0]
+        vm = PikeVm(store)
+        self.assertEqual((vm.starts("xabdacd"), list(vm.ends("abcbdd", 0))), ([1, 4], [5]), "Runs over a CompactAutomata")
+        pattern, dfa = Pattern("(ab|ba)+c*", engine="nfa"), Pattern("(ab|ba)+c*", engine="dfa")
+        strings = ["abba", "abcx", "ba", "", "abab"]
+        matches = pattern.vm.accept(AnchoredMatchingVisitor("abbacabc"))
+        self.assertEqual(matches, dfa.findall("abbacabc"), "Matches: " + str(matches))
+        self.assertEqual(list(pattern.matchMany(strings)), [4, 3, 2, -1, 4], "Match ends: " + str(pattern.matchMany(strings)))
+        self.assertEqual(list(pattern.fullmatchMany(strings)), [True, False, True, False, True],\
+            "Full matches: " + str(pattern.fullmatchMany(strings)))
+
+    def testFollowpos ( self ):
+        for syntax in ("Emily*", "(a|b)*abb", "(ab|ba)+c*", "a|a+b"):
+            dfa = Parser().accept(TreeVisitor(), syntax).accept(FollowposVisitor())
+            self.assertTrue(isinstance(dfa, Automata), "Not an Automata: " + str(dfa))
+            nfa = Automata(Parser().accept(ThompsonVisitor(), syntax)[0])
+            expected = nfa.accept(NfaToDfaVisitor()).accept(MinimizingVisitor())
+            self.assertEqual(len(dfa.accept(MinimizingVisitor())), len(expected), "DFA states of " + syntax)
+            matches = dfa.accept(MatchingVisitor("abbaabbbEmilyabab"))
+            self.assertEqual(matches, expected.accept(MatchingVisitor("abbaabbbEmilyabab")), "Matches of " + syntax)
+        tree = Parser().accept(TreeVisitor(), "(a|b)*a" + "(a|b)" * 12)
+        self.assertRaises(StateBudgetException, tree.accept, FollowposVisitor(None, 100))
+
+    def testCharClass ( self ):
+        cls = CharClass.parse("a-z0-9_", True)
+        self.assertEqual(cls.negate().intervals, ((48, 57), (95, 95), (97, 122)), "Intervals: " + str(cls.negate()))
+        self.assertTrue("A" in cls and "q" not in cls and "\u20ac" in cls, "Membership in " + str(cls))
+        alphabet = Alphabet(["q", CharClass.parse("a-z")])
+        self.assertEqual(alphabet.labelsOf(CharClass.parse("a-z")), [CharClass.parse("a-p"), "q", CharClass.parse("r-z")],\
+            "Atoms: " + str(alphabet.labelsOf(CharClass.parse("a-z"))))
+        self.assertRaises(PatternSyntaxException, compile, "a[bc")
+        self.assertRaises(PatternSyntaxException, compile, "[z-a]")
+        for engine in Pattern.ENGINES:
+            pattern = Pattern("[a-c]+[^a-z]|x.y", engine=engine)
+            matches = pattern.findall("abc1 ca\u20acx\nyxzy") if engine == "dfa" else \
+                pattern.anchored().accept(AnchoredMatchingVisitor("abc1 ca\u20acx\nyxzy"))
+            self.assertEqual(matches, ["abc1", "bc1", "c1", "ca\u20ac", "a\u20ac", "xzy"], "Matches with %s: %s" % (engine, matches))
+        cdfa = Pattern("[a-z0-9]+", engine="dfa").dfa
+        self.assertEqual(cdfa.nclasses, 2, "Classes: %d" % cdfa.nclasses)
+        loaded = CompiledDfa.load(cdfa.accept(SerializingVisitor()))
+        self.assertEqual(loaded.ranges(), cdfa.ranges(), "Class map: " + str(loaded.ranges()))
+
+    def testThreads ( self ):
+        with ThreadPoolExecutor(8) as pool:
+            states = list(pool.map(lambda i: [Automata.State() for j in range(200)], range(8)))
+        ids = [s.id for chunk in states for s in chunk]
+        self.assertEqual(len(set(ids)), len(ids), "State ids allocated twice")
+        parser = Parser()
+        self.assertRaises(Exception, parser.accept, ThompsonVisitor(), "a|")
+        nfa = parser.accept(ThompsonVisitor(), "ab")
+        self.assertEqual(len(nfa), 4, "States left over by a failed parse: " + str(nfa))
+        visitor = CompiledMatchingVisitor("abab")
+        cdfa = compile("ab").dfa
+        self.assertEqual(cdfa.accept(visitor), cdfa.accept(visitor), "Matches kept between calls")
+        documents = ["Emily %d Emil" % i * (i % 5) for i in range(40)]
+        for engine in Pattern.ENGINES:
+            pattern = Pattern("Emily*", engine=engine)
+            spans = pattern.searchMany(documents, 4)
+            self.assertEqual(spans, [list(pattern.finditer(d)) for d in documents], "Spans with " + engine)
+        cache = PatternCache(4)
+        with ThreadPoolExecutor(4) as pool:
+            patterns = list(pool.map(cache.get, ["ab", "a+", "ab", "b*", "ab"] * 4))
+        self.assertEqual((cache.hits + cache.misses, len(cache)), (20, 3), "Cache of %d patterns" % len(cache))
+        self.assertTrue(all(p is cache.get("ab") for p in patterns[::5]), "Patterns compiled twice kept")
+
+    def testIncrementalMatch ( self ):
+        cdfa = compile("Emily*").dfa
+        text = "Emily and Emil, " * 100
+        matcher = IncrementalMatcher(cdfa, text, 16)
+        self.assertEqual(matcher.findall(), cdfa.accept(CompiledMatchingVisitor(text)), "Initial matches")
+        rescanned = matcher.edit(800, 804, "Emilyy")
+        text = text[:800] + "Emilyy" + text[804:]
+        self.assertEqual(matcher.text, text, "Edited text")
+        self.assertEqual(matcher.findall(), cdfa.accept(CompiledMatchingVisitor(text)), "Matches after an edit")
+        self.assertTrue(rescanned < 40, "Rescanned %d characters" % rescanned)
+        matcher.edit(0, 16, "")
+        matcher.append("Emily")
+        self.assertEqual(matcher.spans, IncrementalMatcher(cdfa, text[16:] + "Emily").spans, "Spans after a cut and an append")
+        matcher = compile("ab+").matcher(b"abbxab", 2)
+        matcher.edit(3, 4, b"b")
+        self.assertEqual(matcher.findall(), [b"ab", b"abb", b"abbb", b"ab"], "Matches in bytes: " + str(matcher.findall()))
+        self.assertRaises(IndexError, matcher.edit, 4, 10, b"")
+        pattern = Pattern("(a|b)*a" + "(a|b)" * 12, maxStates=100)
+        self.assertRaises(StateBudgetException, pattern.matcher, "ab")
+        self.assertRaises(StateBudgetException, getattr, pattern, "dfa")
+        matcher = IncrementalMatcher(compile("a+").dfa, "acca", 3)
+        matcher.edit(1, 4, "")
+        self.assertEqual(matcher.spans, [(0, 1)], "Spans after shortening: " + str(matcher.spans))
+        generator = random.Random(0)
+        for syntax in ("a+", "ab|ba", "(a|c)*b"):
+            cdfa = compile(syntax).dfa
+            matcher = IncrementalMatcher(cdfa, "".join(generator.choice("abc") for i in range(40)), 3)
+            for i in range(50):
+                start = generator.randint(0, len(matcher.text))
+                end = generator.randint(start, len(matcher.text))
+                matcher.edit(start, end, "".join(generator.choice("abc") for i in range(generator.choice((0, 1, 4)))))
+                self.assertEqual(matcher.spans, IncrementalMatcher(cdfa, matcher.text, 5).spans,\
+                    "Spans of %s after edits, in %r" % (syntax, matcher.text))
+
+    def testBenchmark ( self ):
+        results = Benchmark((256,), 1, {'word': "Emily*"}).run()
+        entry = results['patterns']['word']
+        self.assertEqual(sorted(entry['times']), ['parse', 'reduce', 'subset', 'thompson', 'tokenize'],\
+            "Stages timed: " + str(sorted(entry['times'])))
+        self.assertEqual(entry['states'], {'nfa': 12, 'dfa': 6, 'reduced': 6}, "States: " + str(entry['states']))
+        self.assertEqual(sorted(entry['matching']['256']), ['match', 'pattern'], "Matchers timed")
+        for matcher in ('match', 'pattern'):
+            self.assertTrue(entry['matching']['256'][matcher]['memory'] > 0, "Peak memory of " + matcher)
+        self.assertEqual([len(Benchmark((), 1).text(size)) for size in (0, 5, 1 << 16, 3 << 16 | 7)],\
+            [0, 5, 1 << 16, 3 << 16 | 7], "Text sizes")
+        self.assertEqual(Benchmark.compare(results, results), [], "Regressions against itself")
+        faster = {'patterns': {'word': dict(entry, times=dict((k, 0.0) for k in entry['times']))}}
+        slower = {'patterns': {'word': dict(entry, times=dict((k, 1.0) for k in entry['times']))}}
+        regressions = Benchmark.compare(slower, faster)
+        self.assertEqual([key for key, before, after in regressions], [('word', stage) for stage in sorted(entry['times'])],\
+            "Regressions: " + str(regressions))
+        visited = []
+        class Pruning(object):     # records whether each DFA comes unreduced, and cuts off its initial state
+            def visit ( self, dfa ):
+                visited.append((dfa, any(dfa.initial.next().values())))
+                for target in dfa.initial.fringe(): dfa.initial.removeTransition(target)
+                return dfa
+        with mock.patch('Benchmark.ReducingVisitor', Pruning):
+            entry, reduced = Benchmark((256,), 3).stages("Emily*")
+        self.assertEqual(entry['states'], {'nfa': 12, 'dfa': 6, 'reduced': 1}, "States: " + str(entry['states']))
+        self.assertEqual([fresh for dfa, fresh in visited], [True] * 4, "Runs on reduced DFAs: " + str(visited))
+
+    def testCountedRepeat ( self ):
+        self.assertEqual(list(Parser().tokenGenerator("a{2,}b{3}")), ["a", Repeat(2, None), "\0", "b", Repeat(3, 3)],\
+            "Tokens: " + str(list(Parser().tokenGenerator("a{2,}b{3}"))))
+        for syntax in ("a{2", "a{x}", "a{3,2}", "a{0}"):
+            self.assertRaises(PatternSyntaxException, compile, syntax)
+        string = "aabaaab1234ab12abab"
+        for syntax in ("a{3}", "(ab){2,}", "[0-9]{2,3}", "(a{1,2}b){2}", "(a*){2}b", "(a+a){0,}", "((b+){2}){0,1}[1-4]*"):
+            expected = Pattern(syntax, engine="dfa").findall(string)
+            for engine in Pattern.ENGINES:
+                pattern = Pattern(syntax, engine=engine)
+                matches = pattern.findall(string) if engine == "dfa" else pattern.anchored().accept(AnchoredMatchingVisitor(string))
+                self.assertEqual(matches, expected, "Matches of %s with %s: %s" % (syntax, engine, matches))
+        patterns = PatternSet(["(a+a){0,}", "((c+){2}){0,1}[ab]*"])
+        self.assertEqual((patterns.matching("a"), patterns.matching("c")), ({1}, set()), "Partial rounds matched")
+        pattern = Pattern("(a|b)*a(a|b){300}")
+        self.assertEqual(pattern.engine, "counting", "Engine of a large count: " + pattern.engine)
+        self.assertEqual(len(pattern.counting), 5, "Positions: %d" % len(pattern.counting))
+        string = "b" + "a" * 301
+        self.assertEqual(list(pattern.finditer(string)), [(0, 302)], "Spans: " + str(list(pattern.finditer(string))))
+        self.assertEqual(list(pattern.fullmatchMany(["a" * 301, "a" * 300])), [True, False], "Full matches")
+        pattern = Pattern("a{5000}b")
+        with mock.patch('Parser.FollowposVisitor', side_effect=AssertionError("DFA built")):
+            full = pattern.fullmatchMany(["a" * 5000 + "b", "a" * 1000])
+        self.assertEqual(list(full), [True, False], "Full matches of a large count")
+        tree = Parser().accept(TreeVisitor(), "(ab){2,3}")
+        self.assertEqual(tree.positions(), 6, "Unrolled positions: %d" % tree.positions())
+        self.assertEqual(tree.accept(CountingVisitor()).starts("ababab"), [0, 2], "Starts")
         
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']